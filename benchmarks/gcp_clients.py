@@ -0,0 +1,85 @@
+"""
+Per-VM overhead of building GCP clients, before and after the shared clients.
+
+    python benchmarks/gcp_clients.py --vms 200 --discovery-ms 50
+
+"before" builds an InstancesClient and an AddressesClient for every VM, as
+the drivers used to. "after" gets them from clients.gcp_client. Each VM then
+does one instances.get.
+
+No request leaves the process. The HTTP transport is stubbed with a canned
+response. Credential discovery is stubbed with a sleep of `--discovery-ms`,
+standing in for the ADC file read or the metadata server round trip.
+"""
+
+import argparse
+import time
+from unittest import mock
+
+import google.auth
+import requests
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import compute_v1
+
+from cloud_instance.util import clients
+
+
+def stub_request(self, method, url, *args, **kwargs):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = b'{"name": "bench-vm"}'
+    response.headers["Content-Type"] = "application/json"
+    response.request = requests.Request(method, url).prepare()
+    return response
+
+
+def run(vms: int, discovery_ms: float, shared: bool) -> tuple[float, int]:
+    discoveries = 0
+
+    def stub_default(*args, **kwargs):
+        nonlocal discoveries
+        discoveries += 1
+        time.sleep(discovery_ms / 1000)
+        return AnonymousCredentials(), "bench-project"
+
+    clients.clients.clear()
+    clients.gcp_credentials = None
+
+    with mock.patch.object(google.auth, "default", stub_default), mock.patch.object(
+        AuthorizedSession, "request", stub_request
+    ):
+        start = time.perf_counter()
+
+        for i in range(vms):
+            if shared:
+                instances = clients.gcp_client("InstancesClient")
+                clients.gcp_client("AddressesClient")
+            else:
+                instances = compute_v1.InstancesClient()
+                compute_v1.AddressesClient()
+
+            instances.get(project="bench-project", zone="us-east4-b", instance=f"vm{i}")
+
+        elapsed = time.perf_counter() - start
+
+    return elapsed, discoveries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--vms", type=int, default=200)
+    parser.add_argument("--discovery-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    for name, shared in (("before", False), ("after", True)):
+        elapsed, discoveries = run(args.vms, args.discovery_ms, shared)
+        print(
+            f"{name:6}  {elapsed * 1000 / args.vms:8.2f} ms/VM  "
+            f"{discoveries:5} credential discoveries  "
+            f"({args.vms} VMs in {elapsed:.2f}s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
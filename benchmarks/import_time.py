@@ -0,0 +1,70 @@
+"""
+Startup import time of the CLI, and a guard against eager provider SDK imports.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --max-ms 300
+
+Imports the module in a fresh interpreter under `python -X importtime`,
+prints the slowest imports, and exits non-zero if boto3, botocore, google.*
+or azure.* was loaded, or if the total exceeds `--max-ms`.
+"""
+
+import argparse
+import subprocess
+import sys
+
+# provider SDKs that must only load once their cloud is used
+FORBIDDEN = ("boto3", "botocore", "google", "azure")
+
+
+def importtime(module: str) -> list[tuple[str, int]]:
+    # (module, cumulative microseconds) of every import, in import order
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        raise SystemExit(f"Importing {module} failed:\n{result.stderr}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        imports.append((name.strip(), int(cumulative)))
+
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--module", default="cloud_instance.cli.cli")
+    parser.add_argument("--max-ms", type=float, default=None)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    imports = importtime(args.module)
+
+    total = next(us for name, us in imports if name == args.module)
+
+    for name, us in sorted(imports, key=lambda x: -x[1])[: args.top]:
+        print(f"{us / 1000:9.1f} ms  {name}")
+    print(f"{total / 1000:9.1f} ms  total for {args.module}")
+
+    loaded = sorted(name for name, _ in imports if name.split(".")[0] in FORBIDDEN)
+    if loaded:
+        raise SystemExit(f"Provider SDKs imported at startup: {', '.join(loaded)}")
+
+    if args.max_ms is not None and total / 1000 > args.max_ms:
+        raise SystemExit(
+            f"Importing {args.module} took {total / 1000:.1f} ms, "
+            f"over the {args.max_ms} ms budget"
+        )
+
+
+if __name__ == "__main__":
+    main()
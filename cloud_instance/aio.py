@@ -0,0 +1,235 @@
+"""
+asyncio API.
+
+    from cloud_instance import aio
+
+    instances = await aio.create("fabio-oddball", deployment, defaults)
+
+    async for x in aio.stream(["fabio-oddball"]):
+        print(x["id"], x["public_ip"])
+
+Each command runs on a thread of a shared pool of CLOUD_INSTANCE_AIO_COMMANDS
+workers, so the event loop is never blocked and up to that many commands,
+eg long creates, run at once. Further commands wait for a free worker. The
+provider calls the commands fan out to are bounded per cloud, region and API
+family by util.throttle, however many commands are in flight.
+
+Cancelling a coroutine only cancels a command still waiting for a worker.
+A command that already started can't be interrupted halfway through a
+create or delete: it runs to completion in the background, its result and
+errors are only logged.
+"""
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable
+
+from .models import ansible
+from .models import create as _create
+from .models import delete as _delete
+from .models import gather as _gather
+from .models import modify as _modify
+from .models import resize as _resize
+from .models import slated as _slated
+
+logger = logging.getLogger("cloud_instance")
+
+# upper bound on the commands running at once, each one holds a worker for
+# its whole duration. Not the loop's default executor, which is much smaller
+AIO_COMMANDS = int(os.getenv("CLOUD_INSTANCE_AIO_COMMANDS", 64))
+
+executor = ThreadPoolExecutor(
+    max_workers=AIO_COMMANDS, thread_name_prefix="cloud_instance_aio"
+)
+
+
+async def run(func: Callable, *args, **kwargs):
+    future = executor.submit(func, *args, **kwargs)
+
+    def done(_):
+        # a command that outlived its cancelled coroutine
+        if future.cancelled():
+            return
+        if future.exception():
+            logger.error(f"Cancelled {func.__name__} failed: {future.exception()}")
+        else:
+            logger.info(f"Cancelled {func.__name__} completed")
+
+    try:
+        return await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        # a command that hasn't started yet is dropped, else it runs on
+        future.cancel()
+        future.add_done_callback(done)
+        raise
+
+
+async def create(
+    deployment_id: str,
+    deployment: list,
+    defaults: dict,
+    preserve: bool = False,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> list[dict]:
+    return await run(
+        _create.create,
+        deployment_id,
+        deployment,
+        defaults,
+        preserve,
+        regions,
+        refresh,
+        clouds,
+    )
+
+
+async def gather(
+    deployment_id: str,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> list[dict]:
+    return await run(_gather.gather, deployment_id, regions, refresh, clouds=clouds)
+
+
+async def gather_many(
+    deployment_ids: list[str],
+    prefix: str | None = None,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> dict[str, list[dict]]:
+    return await run(
+        _gather.gather_many, deployment_ids, prefix, regions, refresh, clouds=clouds
+    )
+
+
+async def stream(
+    deployment_ids: list[str],
+    prefix: str | None = None,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> AsyncIterator[dict]:
+    """
+    Yield the instances of the deployments as soon as each region or zone
+    has been fetched, rather than when the whole fetch is complete.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    # called from the fetch threads
+    def listener(instances: list[dict]):
+        loop.call_soon_threadsafe(queue.put_nowait, instances)
+
+    task = asyncio.ensure_future(
+        run(
+            _gather.gather_many,
+            deployment_ids,
+            prefix,
+            regions,
+            refresh,
+            listener,
+            clouds,
+        )
+    )
+    # wake up the consumer once the fetch is over, even if nothing was found
+    task.add_done_callback(lambda _: queue.put_nowait(None))
+
+    while True:
+        instances = await queue.get()
+        if instances is None:
+            break
+        for x in instances:
+            yield x
+
+    # raise the fetch errors, if any
+    await task
+
+
+async def slated(
+    deployment_id: str,
+    deployment: list,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> list[dict]:
+    return await run(
+        _slated.slated, deployment_id, deployment, regions, refresh, clouds
+    )
+
+
+async def modify(
+    deployment_id: str,
+    new_cpus_count: int,
+    filter_by_groups: list[str] | None = None,
+    sequential: bool = True,
+    pause_between: int = 30,
+    instance_defaults: dict | None = None,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> None:
+    return await run(
+        _modify.modify,
+        deployment_id,
+        new_cpus_count,
+        filter_by_groups or [],
+        sequential,
+        pause_between,
+        instance_defaults or {},
+        regions,
+        refresh,
+        clouds,
+    )
+
+
+async def resize(
+    deployment_id: str,
+    new_disk_size: int,
+    filter_by_groups: list[str] | None = None,
+    sequential: bool = True,
+    pause_between: int = 30,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> None:
+    return await run(
+        _resize.resize,
+        deployment_id,
+        new_disk_size,
+        filter_by_groups or [],
+        sequential,
+        pause_between,
+        regions,
+        refresh,
+        clouds,
+    )
+
+
+async def delete(
+    deployment_ids: list[str],
+    prefix: str | None = None,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> None:
+    return await run(
+        _delete.delete_many, deployment_ids, prefix, regions, refresh, clouds
+    )
+
+
+async def inventory(
+    deployment_ids: list[str],
+    prefix: str | None = None,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> dict:
+    return await run(
+        ansible.inventory, deployment_ids, prefix, regions, refresh, clouds
+    )
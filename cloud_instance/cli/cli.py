@@ -2,16 +2,20 @@
 
 import json
 import logging
+import os
 import platform
 import sys
+from threading import Lock
+from typing import Callable
 
 import typer
 
 # import cloud_instance.utils.common
+from cloud_instance.cli import daemon
 from cloud_instance.cli.dep import EPILOG
 
 # import cloud_instance.cli.util
-from cloud_instance.models import create, delete, gather, modify, resize, slated
+from cloud_instance.models import gather
 
 from .. import __version__
 
@@ -43,6 +47,20 @@ app = typer.Typer(
 
 version: bool = typer.Option(True)
 
+# set by --socket: forward commands to the daemon listening there
+socket_path: str | None = None
+
+
+def call(command: str, listener: Callable | None = None, **kwargs):
+    # run the command in the daemon, if one is configured, else in this process
+    if socket_path:
+        return daemon.request(socket_path, command, kwargs, listener)
+
+    if listener:
+        kwargs["listener"] = listener
+
+    return daemon.COMMANDS[command][0](**kwargs)
+
 
 @app.command(
     name="create",
@@ -70,16 +88,37 @@ def cli_create(
         show_default=False,
         help="Whether to preserve existing VMs.",
     ),
+    regions: str = typer.Option(
+        None,
+        "-r",
+        "--regions",
+        help="comma separated list of AWS regions to search, defaults to the regions in the deployment",
+    ),
+    refresh: bool = typer.Option(
+        False,
+        "--refresh",
+        show_default=False,
+        help="Bypass the inventory cache and fetch from the cloud APIs.",
+    ),
+    clouds: str = typer.Option(
+        None,
+        "--clouds",
+        help="comma separated list of clouds to search (aws, gcp, azure), defaults to the clouds in the deployment",
+    ),
 ):
 
     logger.info(f"START: create {deployment_id=}")
 
     try:
-        result = create.create(
-            deployment_id,
-            json.loads(deployment),
-            json.loads(defaults),
-            preserve,
+        result = call(
+            "create",
+            deployment_id=deployment_id,
+            deployment=json.loads(deployment),
+            defaults=json.loads(defaults),
+            preserve=preserve,
+            regions=regions.split(",") if regions else None,
+            refresh=refresh,
+            clouds=clouds.split(",") if clouds else None,
         )
     except Exception as e:
         print(e, file=sys.stderr)
@@ -96,25 +135,278 @@ def cli_create(
     no_args_is_help=True,
 )
 def cli_gather(
-    deployment_id: str = typer.Option(
-        ...,
+    deployment_id: list[str] = typer.Option(
+        None,
         "-d",
         "--deployment-id",
-        help="The deployment_id",
+        help="The deployment_id, can be repeated",
+    ),
+    prefix: str = typer.Option(
+        None,
+        "--prefix",
+        help="Also include every deployment_id starting with this prefix",
+    ),
+    regions: str = typer.Option(
+        None,
+        "-r",
+        "--regions",
+        help="comma separated list of AWS regions to search, defaults to all enabled regions",
+    ),
+    refresh: bool = typer.Option(
+        False,
+        "--refresh",
+        show_default=False,
+        help="Bypass the inventory cache and fetch from the cloud APIs.",
+    ),
+    clouds: str = typer.Option(
+        None,
+        "--clouds",
+        help="comma separated list of clouds to search (aws, gcp, azure), defaults to all clouds",
+    ),
+    output: str = typer.Option(
+        "json",
+        "-o",
+        "--output",
+        help="Output format: 'json' or 'ndjson', one instance per line followed by a summary line",
+    ),
+    stream: bool = typer.Option(
+        False,
+        "--stream",
+        show_default=False,
+        help="With ndjson output, print each instance as soon as it is fetched.",
+    ),
+    since: str = typer.Option(
+        None,
+        "--since",
+        help="Snapshot file: print only the instances added, removed or changed since it was written, then update it",
+    ),
+    watch: bool = typer.Option(
+        False,
+        "--watch",
+        show_default=False,
+        help="Keep polling and print a ndjson event for every instance added, removed or changed.",
+    ),
+    min_interval: int = typer.Option(
+        5,
+        "--min-interval",
+        help="With --watch, seconds between polls while instances are changing.",
+    ),
+    max_interval: int = typer.Option(
+        300,
+        "--max-interval",
+        help="With --watch, upper bound of the polling interval once stable.",
     ),
 ):
 
-    logger.info(f"START: gather {deployment_id=}")
+    logger.info(f"START: gather {deployment_id=} {prefix=}")
+
+    if not deployment_id and not prefix:
+        print("Either --deployment-id or --prefix is required", file=sys.stderr)
+        sys.exit(1)
+
+    # typer passes None, not [], when the option isn't given
+    deployment_id = deployment_id or []
+
+    if output not in ("json", "ndjson"):
+        print(f"Unknown output format: {output}", file=sys.stderr)
+        sys.exit(1)
+
+    if stream and output != "ndjson":
+        print("--stream requires --output ndjson", file=sys.stderr)
+        sys.exit(1)
+
+    if watch:
+
+        def print_events(delta: dict):
+            if "error" in delta:
+                print(json.dumps({"event": "error", "error": delta["error"]}))
+            for event in ("added", "removed", "changed"):
+                for x in delta.get(event, []):
+                    print(json.dumps({"event": event, "instance": x}))
+            sys.stdout.flush()
+
+        try:
+            gather.watch(
+                deployment_id,
+                prefix,
+                regions.split(",") if regions else None,
+                clouds.split(",") if clouds else None,
+                print_events,
+                min_interval,
+                max_interval,
+            )
+        except KeyboardInterrupt:
+            pass
+
+        logger.info(f"COMPLETED: gather {deployment_id=} {prefix=}")
+        return
+
+    if since:
+        if stream:
+            print("--since can't be combined with --stream", file=sys.stderr)
+            sys.exit(1)
+
+        try:
+            result = call(
+                "gather_delta",
+                # the daemon doesn't share our working directory
+                snapshot_path=os.path.abspath(since),
+                deployment_ids=deployment_id,
+                prefix=prefix,
+                regions=regions.split(",") if regions else None,
+                refresh=refresh,
+                clouds=clouds.split(",") if clouds else None,
+            )
+        except Exception as e:
+            print(e, file=sys.stderr)
+            if output == "ndjson":
+                print(json.dumps({"summary": {"hash": None, "errors": [str(e)]}}))
+            sys.exit(1)
+
+        if output == "ndjson":
+            for event in ("added", "removed", "changed"):
+                for x in result[event]:
+                    print(json.dumps({"event": event, "instance": x}))
+            print(json.dumps({"summary": {"hash": result["hash"], "errors": []}}))
+        else:
+            print(json.dumps(result))
+
+        logger.info(f"COMPLETED: gather {deployment_id=} {prefix=}")
+        return
+
+    count = 0
+    lock = Lock()
+
+    def print_ndjson(instances: list[dict]):
+        nonlocal count
+        # fetch threads call this concurrently
+        with lock:
+            for x in instances:
+                print(json.dumps(x))
+            count += len(instances)
+            sys.stdout.flush()
 
     try:
-        result = gather.gather(deployment_id)
+        if len(deployment_id) == 1 and not prefix:
+            result = call(
+                "gather",
+                print_ndjson if stream else None,
+                deployment_id=deployment_id[0],
+                regions=regions.split(",") if regions else None,
+                refresh=refresh,
+                clouds=clouds.split(",") if clouds else None,
+            )
+        else:
+            # a mapping of deployment_id to its instances
+            result = call(
+                "gather_many",
+                print_ndjson if stream else None,
+                deployment_ids=deployment_id,
+                prefix=prefix,
+                regions=regions.split(",") if regions else None,
+                refresh=refresh,
+                clouds=clouds.split(",") if clouds else None,
+            )
+    except Exception as e:
+        print(e, file=sys.stderr)
+        if output == "ndjson":
+            print(json.dumps({"summary": {"instances": count, "errors": [str(e)]}}))
+        sys.exit(1)
+
+    if output == "ndjson":
+        if not stream:
+            print_ndjson(
+                result
+                if isinstance(result, list)
+                else [x for v in result.values() for x in v]
+            )
+        print(json.dumps({"summary": {"instances": count, "errors": []}}))
+    else:
+        print(json.dumps(result))
+
+    logger.info(f"COMPLETED: gather {deployment_id=} {prefix=}")
+
+
+@app.command(
+    name="inventory",
+    help="Print an Ansible dynamic inventory of the deployment",
+)
+def cli_inventory(
+    deployment_id: list[str] = typer.Option(
+        None,
+        "-d",
+        "--deployment-id",
+        envvar="CLOUD_INSTANCE_DEPLOYMENT_ID",
+        help="The deployment_id, can be repeated",
+    ),
+    prefix: str = typer.Option(
+        None,
+        "--prefix",
+        envvar="CLOUD_INSTANCE_PREFIX",
+        help="Also include every deployment_id starting with this prefix",
+    ),
+    regions: str = typer.Option(
+        None,
+        "-r",
+        "--regions",
+        envvar="CLOUD_INSTANCE_REGIONS",
+        help="comma separated list of AWS regions to search, defaults to all enabled regions",
+    ),
+    refresh: bool = typer.Option(
+        False,
+        "--refresh",
+        show_default=False,
+        help="Bypass the inventory cache and fetch from the cloud APIs.",
+    ),
+    clouds: str = typer.Option(
+        None,
+        "--clouds",
+        envvar="CLOUD_INSTANCE_CLOUDS",
+        help="comma separated list of clouds to search (aws, gcp, azure), defaults to all clouds",
+    ),
+    list_: bool = typer.Option(
+        True,
+        "--list",
+        show_default=False,
+        help="Print the whole inventory, as called by Ansible.",
+    ),
+    host: str = typer.Option(
+        None,
+        "--host",
+        help="Print the variables of a single host, as called by Ansible.",
+    ),
+):
+
+    # hostvars are all in _meta, so there is nothing to say about a single host
+    if host:
+        print(json.dumps({}))
+        return
+
+    logger.info(f"START: inventory {deployment_id=} {prefix=}")
+
+    if not deployment_id and not prefix:
+        print("Either --deployment-id or --prefix is required", file=sys.stderr)
+        sys.exit(1)
+
+    # typer passes None, not [], when the option isn't given
+    deployment_id = deployment_id or []
+
+    try:
+        result = call(
+            "inventory",
+            deployment_ids=deployment_id,
+            prefix=prefix,
+            regions=regions.split(",") if regions else None,
+            refresh=refresh,
+            clouds=clouds.split(",") if clouds else None,
+        )
     except Exception as e:
         print(e, file=sys.stderr)
         sys.exit(1)
 
     print(json.dumps(result))
 
-    logger.info(f"COMPLETED: gather {deployment_id=}")
+    logger.info(f"COMPLETED: inventory {deployment_id=} {prefix=}")
 
 
 @app.command(
@@ -133,14 +425,35 @@ def cli_slated(
         ...,
         help="The deployment_id",
     ),
+    regions: str = typer.Option(
+        None,
+        "-r",
+        "--regions",
+        help="comma separated list of AWS regions to search, defaults to the regions in the deployment",
+    ),
+    refresh: bool = typer.Option(
+        False,
+        "--refresh",
+        show_default=False,
+        help="Bypass the inventory cache and fetch from the cloud APIs.",
+    ),
+    clouds: str = typer.Option(
+        None,
+        "--clouds",
+        help="comma separated list of clouds to search (aws, gcp, azure), defaults to the clouds in the deployment",
+    ),
 ):
 
     logger.info(f"START: slated {deployment_id=}")
 
     try:
-        result = slated.slated(
-            deployment_id,
-            json.loads(deployment),
+        result = call(
+            "slated",
+            deployment_id=deployment_id,
+            deployment=json.loads(deployment),
+            regions=regions.split(",") if regions else None,
+            refresh=refresh,
+            clouds=clouds.split(",") if clouds else None,
         )
     except Exception as e:
         print(e, file=sys.stderr)
@@ -191,17 +504,38 @@ def cli_modify(
         ...,
         help="defaults",
     ),
+    regions: str = typer.Option(
+        None,
+        "-r",
+        "--regions",
+        help="comma separated list of AWS regions to search, defaults to all enabled regions",
+    ),
+    refresh: bool = typer.Option(
+        False,
+        "--refresh",
+        show_default=False,
+        help="Bypass the inventory cache and fetch from the cloud APIs.",
+    ),
+    clouds: str = typer.Option(
+        None,
+        "--clouds",
+        help="comma separated list of clouds to search (aws, gcp, azure), defaults to all clouds",
+    ),
 ):
 
     logger.info(f"START: modify-instance-type {deployment_id=}")
 
-    modify.modify(
-        deployment_id,
-        new_cpus_count,
-        filter_by_groups.split(",") if filter_by_groups else [],
-        sequential,
-        pause_between,
-        json.loads(defaults),
+    call(
+        "modify",
+        deployment_id=deployment_id,
+        new_cpus_count=new_cpus_count,
+        filter_by_groups=filter_by_groups.split(",") if filter_by_groups else [],
+        sequential=sequential,
+        pause_between=pause_between,
+        instance_defaults=json.loads(defaults),
+        regions=regions.split(",") if regions else None,
+        refresh=refresh,
+        clouds=clouds.split(",") if clouds else None,
     )
 
     logger.info(f"COMPLETED: modify-instance-type {deployment_id=}")
@@ -243,16 +577,37 @@ def cli_resize(
         "--pause-between",
         help="If sequential, seconds to pause between modifications.",
     ),
+    regions: str = typer.Option(
+        None,
+        "-r",
+        "--regions",
+        help="comma separated list of AWS regions to search, defaults to all enabled regions",
+    ),
+    refresh: bool = typer.Option(
+        False,
+        "--refresh",
+        show_default=False,
+        help="Bypass the inventory cache and fetch from the cloud APIs.",
+    ),
+    clouds: str = typer.Option(
+        None,
+        "--clouds",
+        help="comma separated list of clouds to search (aws, gcp, azure), defaults to all clouds",
+    ),
 ):
 
     logger.info(f"START: resize {deployment_id=}")
 
-    resize.resize(
-        deployment_id,
-        new_disk_size,
-        filter_by_groups.split(",") if filter_by_groups else [],
-        sequential,
-        pause_between,
+    call(
+        "resize",
+        deployment_id=deployment_id,
+        new_disk_size=new_disk_size,
+        filter_by_groups=filter_by_groups.split(",") if filter_by_groups else [],
+        sequential=sequential,
+        pause_between=pause_between,
+        regions=regions.split(",") if regions else None,
+        refresh=refresh,
+        clouds=clouds.split(",") if clouds else None,
     )
 
     logger.info(f"COMPLETED: resize {deployment_id=}")
@@ -264,19 +619,82 @@ def cli_resize(
     no_args_is_help=True,
 )
 def cli_delete(
-    deployment_id: str = typer.Option(
-        ...,
+    deployment_id: list[str] = typer.Option(
+        None,
         "-d",
         "--deployment-id",
-        help="The deployment_id",
+        help="The deployment_id, can be repeated",
+    ),
+    prefix: str = typer.Option(
+        None,
+        "--prefix",
+        help="Also include every deployment_id starting with this prefix",
+    ),
+    regions: str = typer.Option(
+        None,
+        "-r",
+        "--regions",
+        help="comma separated list of AWS regions to search, defaults to all enabled regions",
+    ),
+    refresh: bool = typer.Option(
+        False,
+        "--refresh",
+        show_default=False,
+        help="Bypass the inventory cache and fetch from the cloud APIs.",
+    ),
+    clouds: str = typer.Option(
+        None,
+        "--clouds",
+        help="comma separated list of clouds to search (aws, gcp, azure), defaults to all clouds",
     ),
 ):
 
-    logger.info(f"START: delete {deployment_id=}")
+    logger.info(f"START: delete {deployment_id=} {prefix=}")
+
+    if not deployment_id and not prefix:
+        print("Either --deployment-id or --prefix is required", file=sys.stderr)
+        sys.exit(1)
 
-    delete.delete(deployment_id)
+    # typer passes None, not [], when the option isn't given
+    deployment_id = deployment_id or []
 
-    logger.info(f"COMPLETED: delete {deployment_id=}")
+    call(
+        "delete",
+        deployment_ids=deployment_id,
+        prefix=prefix,
+        regions=regions.split(",") if regions else None,
+        refresh=refresh,
+        clouds=clouds.split(",") if clouds else None,
+    )
+
+    logger.info(f"COMPLETED: delete {deployment_id=} {prefix=}")
+
+
+@app.command(
+    name="serve",
+    help="Run a daemon serving the other commands over a Unix socket",
+)
+def cli_serve(
+    socket: str = typer.Option(
+        os.path.join(os.path.expanduser("~"), ".cloud_instance.sock"),
+        "-s",
+        "--socket",
+        envvar="CLOUD_INSTANCE_SOCKET",
+        help="Path of the Unix socket to listen on",
+    ),
+):
+
+    logger.info(f"START: serve {socket=}")
+
+    try:
+        daemon.serve(socket)
+    except KeyboardInterrupt:
+        pass
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    logger.info(f"COMPLETED: serve {socket=}")
 
 
 def _version_callback(value: bool) -> None:
@@ -295,8 +713,15 @@ def version_option(
         callback=_version_callback,
         help="Print the version and exit",
     ),
+    socket: str = typer.Option(
+        None,
+        "--socket",
+        envvar="CLOUD_INSTANCE_SOCKET",
+        help="Forward the command to the daemon listening on this Unix socket, see 'serve'",
+    ),
 ) -> None:
-    pass
+    global socket_path
+    socket_path = socket
 
 
 # this is only needed for mkdocs-click
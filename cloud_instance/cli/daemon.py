@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+from threading import Condition, Lock
+from typing import Callable
+
+from cloud_instance.models import (
+    ansible,
+    create,
+    delete,
+    gather,
+    modify,
+    resize,
+    slated,
+)
+
+logger = logging.getLogger("cloud_instance")
+
+# command name -> (function, whether it mutates the deployment)
+COMMANDS: dict[str, tuple[Callable, bool]] = {
+    "create": (create.create, True),
+    "gather": (gather.gather, False),
+    "gather_many": (gather.gather_many, False),
+    "gather_delta": (gather.gather_delta, False),
+    "inventory": (ansible.inventory, False),
+    "slated": (slated.slated, False),
+    "modify": (modify.modify, True),
+    "resize": (resize.resize, True),
+    "delete": (delete.delete_many, True),
+}
+
+# commands that can stream instances back through a `listener`
+STREAMING = ("gather", "gather_many")
+
+# environment variables the commands read: a forwarded command must see the
+# same ones as if it ran in the client
+ENV_PREFIXES = ("CLOUD_INSTANCE_", "AWS_", "GCP_", "GOOGLE_", "AZURE_")
+
+# only read by the CLI itself, so they can differ between client and daemon
+CLI_ENV = {
+    "CLOUD_INSTANCE_SOCKET",
+    "CLOUD_INSTANCE_DEPLOYMENT_ID",
+    "CLOUD_INSTANCE_PREFIX",
+    "CLOUD_INSTANCE_REGIONS",
+    "CLOUD_INSTANCE_CLOUDS",
+}
+
+
+def get_env() -> dict[str, str]:
+    return {
+        k: v
+        for k, v in os.environ.items()
+        if k.startswith(ENV_PREFIXES) and k not in CLI_ENV
+    }
+
+
+class RWLock:
+    # many readers or a single writer
+
+    def __init__(self):
+        self.cond = Condition()
+        self.readers = 0
+        self.writer = False
+
+    def acquire(self, write: bool):
+        with self.cond:
+            if write:
+                self.cond.wait_for(lambda: not self.writer and not self.readers)
+                self.writer = True
+            else:
+                self.cond.wait_for(lambda: not self.writer)
+                self.readers += 1
+
+    def release(self, write: bool):
+        with self.cond:
+            if write:
+                self.writer = False
+            else:
+                self.readers -= 1
+            self.cond.notify_all()
+
+
+locks: dict[str, RWLock] = {}
+locks_lock = Lock()
+
+# taken for writing by mutations selecting deployments by prefix,
+# whose deployment_ids aren't known upfront, and for reading by everything else
+prefix_lock = RWLock()
+
+
+def get_lock(deployment_id: str) -> RWLock:
+    with locks_lock:
+        return locks.setdefault(deployment_id, RWLock())
+
+
+def run(command: str, kwargs: dict, listener: Callable | None = None):
+    func, mutates = COMMANDS[command]
+
+    deployment_ids = kwargs.get("deployment_ids") or [kwargs.get("deployment_id")]
+    deployment_ids = sorted(x for x in deployment_ids if x)
+    by_prefix = bool(kwargs.get("prefix"))
+
+    if listener:
+        kwargs = {**kwargs, "listener": listener}
+
+    # always lock in the same order to avoid deadlocks
+    prefix_lock.acquire(mutates and by_prefix)
+    held = [get_lock(x) for x in deployment_ids]
+    try:
+        for x in held:
+            x.acquire(mutates)
+        try:
+            return func(**kwargs)
+        finally:
+            for x in reversed(held):
+                x.release(mutates)
+    finally:
+        prefix_lock.release(mutates and by_prefix)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        send_lock = Lock()
+
+        def send(msg: dict):
+            with send_lock:
+                self.wfile.write((json.dumps(msg) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+        try:
+            line = self.rfile.readline()
+            # a liveness probe from another 'serve'
+            if not line:
+                return
+
+            req = json.loads(line)
+            command = req["command"]
+
+            # the daemon can't switch environments per request, so refuse
+            # rather than silently use its own
+            env = get_env()
+            client_env = {
+                k: v for k, v in req.get("env", {}).items() if k not in CLI_ENV
+            }
+            differ = sorted(
+                k
+                for k in env.keys() | client_env.keys()
+                if env.get(k) != client_env.get(k)
+            )
+            if differ:
+                raise ValueError(
+                    f"The daemon runs with different {', '.join(differ)}: "
+                    "restart 'serve' with this environment, or run without --socket"
+                )
+
+            logger.info(f"DAEMON START: {command} {req.get('kwargs')}")
+
+            listener = None
+            if req.get("stream") and command in STREAMING:
+                listener = lambda instances: send({"instances": instances})
+
+            result = run(command, req.get("kwargs", {}), listener)
+
+            send({"result": result})
+
+            logger.info(f"DAEMON COMPLETED: {command}")
+
+        except Exception as e:
+            logger.error(f"DAEMON FAILED: {e}")
+            try:
+                send({"error": str(e)})
+            except OSError:
+                pass
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path: str) -> None:
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # left behind by a daemon that is gone
+                os.remove(socket_path)
+            else:
+                raise ValueError(f"A daemon is already serving on {socket_path}")
+
+    # only the owner can connect, from the moment the socket exists
+    umask = os.umask(0o177)
+    try:
+        server = Server(socket_path, Handler)
+    finally:
+        os.umask(umask)
+
+    with server:
+        logger.info(f"Serving on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+def request(
+    socket_path: str,
+    command: str,
+    kwargs: dict,
+    listener: Callable | None = None,
+):
+    """
+    Forward `command` to the daemon listening on `socket_path` and return its
+    result. Streamed instances are passed to `listener` as they arrive.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(
+            (
+                json.dumps(
+                    {
+                        "command": command,
+                        "kwargs": kwargs,
+                        "stream": listener is not None,
+                        "env": get_env(),
+                    }
+                )
+                + "\n"
+            ).encode("utf-8")
+        )
+
+        for line in sock.makefile("r", encoding="utf-8"):
+            msg = json.loads(line)
+            if "instances" in msg:
+                if listener:
+                    listener(msg["instances"])
+            elif "error" in msg:
+                raise ValueError(msg["error"])
+            else:
+                return msg["result"]
+
+    raise ValueError("Connection to the daemon closed unexpectedly")
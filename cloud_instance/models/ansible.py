@@ -0,0 +1,69 @@
+import json
+import logging
+
+# setup global logger
+logger = logging.getLogger("cloud_instance")
+
+from .gather import gather_many
+
+
+def inventory(
+    deployment_ids: list[str],
+    prefix: str | None = None,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> dict:
+
+    current_instances = [
+        x
+        for v in gather_many(
+            deployment_ids, prefix, regions, refresh, clouds=clouds
+        ).values()
+        for x in v
+    ]
+
+    logger.info("Building Ansible inventory")
+
+    return build_inventory(current_instances)
+
+
+def build_inventory(instances: list[dict]) -> dict:
+    """
+    Build an Ansible dynamic inventory document.
+
+    Group membership comes from `inventory_groups` and `cluster_name`, and
+    `_meta.hostvars` carries `ansible_user` plus the instance's `extra_vars`,
+    so Ansible never has to call back per host.
+    """
+    groups: dict[str, set] = {}
+    hostvars: dict[str, dict] = {}
+
+    for x in instances:
+        host = x["public_ip"] or x["private_ip"]
+
+        hostvars[host] = {
+            "ansible_host": host,
+            "ansible_user": x["ansible_user"],
+            "instance_id": x["id"],
+            "deployment_id": x["deployment_id"],
+            "cloud": x["cloud"],
+            "region": x["region"],
+            "zone": x["zone"],
+            "public_ip": x["public_ip"],
+            "public_hostname": x["public_hostname"],
+            "private_ip": x["private_ip"],
+            "private_hostname": x["private_hostname"],
+            "cluster_name": x["cluster_name"],
+            "group_name": x["group_name"],
+            **json.loads(x["extra_vars"] or "{}"),
+        }
+
+        for g in set(x["inventory_groups"] + [x["cluster_name"]]):
+            groups.setdefault(g, set()).add(host)
+
+    doc = {k: {"hosts": sorted(v)} for k, v in groups.items()}
+    doc["all"] = {"children": sorted(groups)}
+    doc["_meta"] = {"hostvars": hostvars}
+
+    return doc
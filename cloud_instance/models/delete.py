@@ -1,19 +1,41 @@
 import logging
 
-from ..util.fetch import fetch
+from ..util.fetch import fetch_many
 from ..util.terminate import terminate
 
 logger = logging.getLogger("cloud_instance")
 
-errors: list[str] = []
 
+def delete(
+    deployment_id: str,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> None:
 
-def delete(deployment_id: str) -> None:
+    delete_many([deployment_id], None, regions, refresh, clouds)
+
+
+def delete_many(
+    deployment_ids: list[str] | None,
+    prefix: str | None = None,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> None:
+
+    deployment_ids = deployment_ids or []
 
     try:
-        current_instances = fetch(deployment_id)
+        current_instances = [
+            x
+            for v in fetch_many(
+                deployment_ids, prefix, regions, refresh, clouds=clouds
+            ).values()
+            for x in v
+        ]
     except:
-        raise ValueError(f"Failed to fetch instances for {deployment_id=}")
+        raise ValueError(f"Failed to fetch instances for {deployment_ids=} {prefix=}")
 
     logger.info(f"current_instances count={len(current_instances)}")
     for idx, x in enumerate(current_instances, start=1):
@@ -1,24 +1,147 @@
 import logging
+import time
+from typing import Callable
 
 # setup global logger
 logger = logging.getLogger("cloud_instance")
 
-from ..util.fetch import fetch
+from ..util import snapshot
+from ..util.fetch import fetch, fetch_many
 
 
 def gather(
     deployment_id: str,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    listener: Callable[[list[dict]], None] | None = None,
+    clouds: list[str] | None = None,
 ) -> list[dict]:
 
     logger.info(f"Fetching all instances with {deployment_id=}")
 
     try:
-        current_instances = fetch(deployment_id)
-    except:
-        raise ValueError(f"Failed to fetch instances for {deployment_id=}")
+        # reads may be served by the fetch of create or slated, see inventory.get
+        current_instances = fetch(
+            deployment_id, regions, refresh, listener, clouds, trust_spec=True
+        )
+    except Exception as e:
+        raise ValueError(f"Failed to fetch instances for {deployment_id=}: {e}")
 
     logger.info(f"current_instances count={len(current_instances)}")
     for idx, x in enumerate(current_instances, start=1):
         logger.info(f"{idx}:\t{x}")
 
     return current_instances
+
+
+def gather_many(
+    deployment_ids: list[str],
+    prefix: str | None = None,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    listener: Callable[[list[dict]], None] | None = None,
+    clouds: list[str] | None = None,
+) -> dict[str, list[dict]]:
+
+    logger.info(f"Fetching all instances with {deployment_ids=} {prefix=}")
+
+    try:
+        current_instances = fetch_many(
+            deployment_ids, prefix, regions, refresh, listener, clouds, trust_spec=True
+        )
+    except Exception as e:
+        raise ValueError(
+            f"Failed to fetch instances for {deployment_ids=} {prefix=}: {e}"
+        )
+
+    for k, v in current_instances.items():
+        logger.info(f"{k} current_instances count={len(v)}")
+
+    return current_instances
+
+
+def gather_delta(
+    snapshot_path: str,
+    deployment_ids: list[str],
+    prefix: str | None = None,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
+) -> dict:
+
+    current_instances = [
+        x
+        for v in gather_many(
+            deployment_ids, prefix, regions, refresh, clouds=clouds
+        ).values()
+        for x in v
+    ]
+
+    logger.info(f"Comparing with snapshot {snapshot_path}")
+
+    result = snapshot.delta(snapshot_path, current_instances)
+
+    logger.info(
+        f"added={len(result['added'])} removed={len(result['removed'])} "
+        f"changed={len(result['changed'])}"
+    )
+
+    return result
+
+
+def watch(
+    deployment_ids: list[str],
+    prefix: str | None = None,
+    regions: list[str] | None = None,
+    clouds: list[str] | None = None,
+    on_delta: Callable[[dict], None] = print,
+    min_interval: int = 5,
+    max_interval: int = 300,
+) -> None:
+    """
+    Poll the deployments until interrupted and call `on_delta` on every change.
+
+    The first poll reports every instance as added. The interval resets to
+    `min_interval` whenever something changed and stays there while any
+    instance is still pending, so instances that are coming up or going away
+    are followed closely. It doubles up to `max_interval` while the
+    deployments are stable.
+    """
+    previous: list[dict] = []
+    previous_hash = None
+    interval = min_interval
+
+    while True:
+        try:
+            current_instances = [
+                x
+                for v in fetch_many(
+                    deployment_ids, prefix, regions, True, clouds=clouds
+                ).values()
+                for x in v
+            ]
+        except Exception as e:
+            logger.error(f"Watch poll failed: {e}")
+            on_delta({"error": str(e)})
+            interval = min(interval * 2, max_interval)
+            time.sleep(interval)
+            continue
+
+        current_hash = snapshot.digest(current_instances)
+
+        if current_hash != previous_hash:
+            delta = snapshot.diff(previous, current_instances)
+            logger.info(
+                f"added={len(delta['added'])} removed={len(delta['removed'])} "
+                f"changed={len(delta['changed'])}"
+            )
+            on_delta({"hash": current_hash, **delta})
+            previous, previous_hash = current_instances, current_hash
+            interval = min_interval
+        elif any(x.get("state", "running") != "running" for x in current_instances):
+            interval = min_interval
+        else:
+            interval = min(interval * 2, max_interval)
+
+        logger.debug(f"Next poll in {interval} seconds")
+        time.sleep(interval)
@@ -3,50 +3,31 @@ import logging
 import os
 import random
 import time
-from threading import Lock, Thread
-
-# AWS
-import boto3
-
-# AZURE
-from azure.identity import EnvironmentCredential
-from azure.mgmt.compute import ComputeManagementClient
-from google.api_core.extended_operation import ExtendedOperation
-
-# GCP
-from google.cloud.compute_v1 import InstancesClient, InstancesSetMachineTypeRequest
+from threading import Thread
 
+from ..util import poller, throttle
+from ..util.clients import aws_client, azure_compute_client, gcp_client
 from ..util.common import wait_for_extended_operation
+from ..util.context import RunContext
 from ..util.fetch import fetch
 
 logger = logging.getLogger("cloud_instance")
 
-errors: list[str] = []
-defaults: dict = {}
-
 
-def update_errors(error: str):
-    global errors
-    logger.error(error)
-    with Lock():
-        errors.append(error)
-
-
-def get_instance_type(group: dict):
+def get_instance_type(ctx: RunContext, group: dict):
     if "instance_type" in group:
         return group["instance_type"]
 
     # instance type
     cpu = str(group["instance"].get("cpu"))
     if cpu == "None":
-        update_errors("instance cpu cannot be null")
+        ctx.add_error("instance cpu cannot be null")
         return
 
     mem = str(group["instance"].get("mem", "default"))
     cloud = group["cloud"]
-    global defaults
 
-    return defaults[cloud][cpu][mem]
+    return ctx.defaults[cloud][cpu][mem]
 
 
 def modify(
@@ -56,12 +37,17 @@ def modify(
     sequential: bool = True,
     pause_between: int = 30,
     instance_defaults: dict = {},
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
 ) -> None:
 
+    ctx = RunContext(instance_defaults)
+
     logger.info(f"Fetching all instances with {deployment_id=}")
 
     try:
-        current_instances = fetch(deployment_id)
+        current_instances = fetch(deployment_id, regions, refresh, clouds=clouds)
     except:
         raise ValueError(f"Failed to fetch instances for {deployment_id=}")
 
@@ -80,17 +66,14 @@ def modify(
         ):
             filtered_instances.append(x)
 
-    global defaults
-    defaults = instance_defaults
-
     if sequential:
         for x in filtered_instances:
             if x["cloud"] == "aws":
-                modify_aws_vm(x, new_cpus_count)
+                modify_aws_vm(ctx, x, new_cpus_count)
             elif x["cloud"] == "gcp":
-                modify_gcp_vm(x, new_cpus_count)
+                modify_gcp_vm(ctx, x, new_cpus_count)
             else:
-                modify_azure_vm(x, new_cpus_count)
+                modify_azure_vm(ctx, x, new_cpus_count)
 
             logger.info(f"Pausing for {pause_between} seconds...")
             time.sleep(pause_between)
@@ -103,7 +86,7 @@ def modify(
                     "gcp": modify_gcp_vm,
                     "azure": modify_azure_vm,
                 }.get(x["cloud"]),
-                args=(x, new_cpus_count),
+                args=(ctx, x, new_cpus_count),
             )
             t.start()
             threads.append(t)
@@ -111,37 +94,46 @@ def modify(
         for x in threads:
             x.join()
 
-    global errors
-
-    if errors:
+    if ctx.errors:
         raise ValueError(f"Failed to modify instances for {deployment_id=}")
 
 
-def modify_aws_vm(x: dict, new_cpus_count):
+def modify_aws_vm(ctx: RunContext, x: dict, new_cpus_count):
     instance_id = x["id"]
 
     try:
-        client = boto3.client("ec2", region_name=x["region"])
+        client = aws_client("ec2", x["region"])
 
         logger.info(f"Modifying {instance_id=} {new_cpus_count=}")
 
         # 1) Stop (required to change type)
-        client.stop_instances(InstanceIds=[instance_id])
-        client.get_waiter("instance_stopped").wait(InstanceIds=[instance_id])
+        throttle.call(
+            "aws",
+            x["region"],
+            "stop_instances",
+            client.stop_instances,
+            InstanceIds=[instance_id],
+        )
+        poller.wait(x["region"], [instance_id], "stopped")
 
         logger.info(f"Stopped {instance_id}")
 
         # 2) Modify type
         new_instance_type = get_instance_type(
+            ctx,
             {
                 "cloud": x["cloud"],
                 "instance": {
                     "cpu": new_cpus_count,
                 },
-            }
+            },
         )
 
-        client.modify_instance_attribute(
+        throttle.call(
+            "aws",
+            x["region"],
+            "modify_instance_attribute",
+            client.modify_instance_attribute,
             InstanceId=instance_id,
             InstanceType={"Value": new_instance_type},
         )
@@ -149,28 +141,36 @@ def modify_aws_vm(x: dict, new_cpus_count):
         logger.info(f"Modified {instance_id} to {new_instance_type}")
 
         # 3) Start
-        client.start_instances(InstanceIds=[instance_id])
-        client.get_waiter("instance_running").wait(InstanceIds=[instance_id])
+        throttle.call(
+            "aws",
+            x["region"],
+            "start_instances",
+            client.start_instances,
+            InstanceIds=[instance_id],
+        )
+        poller.wait(x["region"], [instance_id], "running")
 
         logger.info(f"Restarted {instance_id}")
 
     except Exception as e:
-        update_errors(e)
+        ctx.add_error(e)
 
 
-def modify_gcp_vm(x: dict, new_cpus_count: int):
+def modify_gcp_vm(ctx: RunContext, x: dict, new_cpus_count: int):
+    # GCP
+    from google.cloud.compute_v1 import InstancesSetMachineTypeRequest
 
     instance_id = x["id"]
 
     gcp_project = os.getenv("GCP_PROJECT")
     if not gcp_project:
-        update_errors("GCP_PROJECT env var is not defined")
+        ctx.add_error("GCP_PROJECT env var is not defined")
         return
 
     gcpzone = f"{x['region']}-{x['zone']}"
 
     try:
-        client = InstancesClient()
+        client = gcp_client("InstancesClient")
 
         logger.info(f"Modifying {instance_id=} {new_cpus_count=}")
 
@@ -181,12 +181,13 @@ def modify_gcp_vm(x: dict, new_cpus_count: int):
 
         # 2) Set the new machine type
         new_instance_type = get_instance_type(
+            ctx,
             {
                 "cloud": x["cloud"],
                 "instance": {
                     "cpu": new_cpus_count,
                 },
-            }
+            },
         )
 
         req = InstancesSetMachineTypeRequest(
@@ -207,10 +208,11 @@ def modify_gcp_vm(x: dict, new_cpus_count: int):
         logger.info(f"Restarted {instance_id}")
 
     except Exception as e:
-        update_errors(e)
+        ctx.add_error(e)
 
 
 def modify_azure_vm(
+    ctx: RunContext,
     deployment_id: str,
     cluster_name: str,
     group: dict,
@@ -225,9 +227,7 @@ def modify_azure_vm(
     logger.debug("++azure %s %s %s" % (cluster_name, group["group_name"], x))
 
     try:
-        # Acquire a credential object using CLI-based authentication.
-        credential = EnvironmentCredential()
-        client = ComputeManagementClient(credential, azure_subscription_id)
+        client = azure_compute_client(azure_subscription_id)
 
         instance_name = deployment_id + "-" + str(random.randint(0, 1e16)).zfill(16)
 
@@ -315,7 +315,7 @@ def modify_azure_vm(
                     "data_disks": vols,
                 },
                 "hardware_profile": {
-                    "vm_size": get_instance_type(group),
+                    "vm_size": get_instance_type(ctx, group),
                 },
                 "os_profile": {
                     "computer_name": instance_name,
@@ -380,4 +380,4 @@ def modify_azure_vm(
 
     except Exception as e:
         logger.error(e)
-        update_errors(e)
+        ctx.add_error(e)
@@ -3,33 +3,15 @@ import logging
 import os
 import random
 import time
-from threading import Lock, Thread
+from threading import Thread
 
-# AWS
-import boto3
-
-# AZURE
-from azure.identity import EnvironmentCredential
-from azure.mgmt.compute import ComputeManagementClient
-from google.api_core.extended_operation import ExtendedOperation
-
-# GCP
-from google.cloud.compute_v1 import DisksClient, DisksResizeRequest, InstancesClient
-
-from ..util.common import wait_for_extended_operation
+from ..util import operations, throttle
+from ..util.clients import aws_client, azure_compute_client, gcp_client
+from ..util.context import RunContext
 from ..util.fetch import fetch
 
 logger = logging.getLogger("cloud_instance")
 
-errors: list[str] = []
-
-
-def update_errors(error: str):
-    global errors
-    logger.error(error)
-    with Lock():
-        errors.append(error)
-
 
 def resize(
     deployment_id: str,
@@ -37,12 +19,17 @@ def resize(
     filter_by_groups: list[str] = [],
     sequential: bool = True,
     pause_between: int = 30,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
 ) -> None:
 
+    ctx = RunContext()
+
     logger.info(f"Fetching all instances with {deployment_id=}")
 
     try:
-        current_instances = fetch(deployment_id)
+        current_instances = fetch(deployment_id, regions, refresh, clouds=clouds)
     except:
         raise ValueError(f"Failed to fetch instances for {deployment_id=}")
 
@@ -64,11 +51,11 @@ def resize(
     if sequential:
         for x in filtered_instances:
             if x["cloud"] == "aws":
-                resize_aws_vm(x, new_disk_size)
+                resize_aws_vm(ctx, x, new_disk_size)
             elif x["cloud"] == "gcp":
-                resize_gcp_vm(x, new_disk_size)
+                resize_gcp_vm(ctx, x, new_disk_size)
             else:
-                resize_azure_vm(x, new_disk_size)
+                resize_azure_vm(ctx, x, new_disk_size)
 
             logger.info(f"Pausing for {pause_between} seconds...")
             time.sleep(pause_between)
@@ -81,7 +68,7 @@ def resize(
                     "gcp": resize_gcp_vm,
                     "azure": resize_azure_vm,
                 }.get(x["cloud"]),
-                args=(x, new_disk_size),
+                args=(ctx, x, new_disk_size),
             )
             t.start()
             threads.append(t)
@@ -89,19 +76,23 @@ def resize(
         for x in threads:
             x.join()
 
-    global errors
-
-    if errors:
+    if ctx.errors:
         raise ValueError(f"Failed to resize instances for {deployment_id=}")
 
 
-def resize_aws_vm(x: dict, new_disk_size):
+def resize_aws_vm(ctx: RunContext, x: dict, new_disk_size):
     instance_id = x["id"]
 
-    client = boto3.client("ec2", region_name=x["region"])
+    client = aws_client("ec2", x["region"])
 
     def get_volume_id(instance_id: str) -> str:
-        resp = client.describe_instances(InstanceIds=[instance_id])
+        resp = throttle.call(
+            "aws",
+            x["region"],
+            "describe",
+            client.describe_instances,
+            InstanceIds=[instance_id],
+        )
         reservations = resp.get("Reservations", [])
         for r in reservations:
             for inst in r.get("Instances", []):
@@ -116,9 +107,13 @@ def resize_aws_vm(x: dict, new_disk_size):
         """
         start = time.time()
         while True:
-            mods = client.describe_volumes_modifications(VolumeIds=[volume_id]).get(
-                "VolumesModifications", []
-            )
+            mods = throttle.call(
+                "aws",
+                x["region"],
+                "describe",
+                client.describe_volumes_modifications,
+                VolumeIds=[volume_id],
+            ).get("VolumesModifications", [])
             state = mods[0]["ModificationState"] if mods else "unknown"
             if state in ("optimizing", "completed"):
                 return state
@@ -133,49 +128,65 @@ def resize_aws_vm(x: dict, new_disk_size):
         logger.info(f"Resize {instance_id=} {new_disk_size=}")
 
         vol_id = get_volume_id(instance_id)
-        vol = boto3.client("ec2", region_name=x["region"]).describe_volumes(
-            VolumeIds=[vol_id]
+        vol = throttle.call(
+            "aws",
+            x["region"],
+            "describe",
+            client.describe_volumes,
+            VolumeIds=[vol_id],
         )["Volumes"][0]
         current_size = vol["Size"]
 
         if new_disk_size <= current_size:
-            update_errors(
+            ctx.add_error(
                 f"Volume {vol_id} is already {current_size} GiB (>= {new_disk_size}). Nothing to do."
             )
             return
 
         logger.info(f"Resizing {vol_id} from {current_size} -> {new_disk_size} GiB ...")
-        client.modify_volume(VolumeId=vol_id, Size=new_disk_size)
+        throttle.call(
+            "aws",
+            x["region"],
+            "modify_volume",
+            client.modify_volume,
+            VolumeId=vol_id,
+            Size=new_disk_size,
+        )
 
         wait_for_resize(vol_id)
 
         logger.info(f"Resize complete for volume {vol_id}.")
 
     except Exception as e:
-        update_errors(e)
+        ctx.add_error(e)
 
 
-def resize_gcp_vm(x: dict, new_disk_size: int):
+def resize_gcp_vm(ctx: RunContext, x: dict, new_disk_size: int):
+    # GCP
+    from google.cloud.compute_v1 import DisksResizeRequest
 
     instance_id = x["id"]
 
     gcp_project = os.getenv("GCP_PROJECT")
     if not gcp_project:
-        update_errors("GCP_PROJECT env var is not defined")
+        ctx.add_error("GCP_PROJECT env var is not defined")
         return
 
     gcpzone = f"{x['region']}-{x['zone']}"
 
     try:
 
-        client = InstancesClient()
+        client = gcp_client("InstancesClient")
         instance = client.get(
             project=gcp_project,
             zone=gcpzone,
             instance=instance_id,
         )
 
-        disk_client = DisksClient()
+        disk_client = gcp_client("DisksClient")
+
+        # resize all data disks at once, then wait on them together
+        ops = []
 
         for disk in instance.disks:
             # `source` is a full URL, last part is the disk name
@@ -184,22 +195,26 @@ def resize_gcp_vm(x: dict, new_disk_size: int):
 
                 logger.info(f"Modifying {instance_id=} {new_disk_size=}")
 
-                op = disk_client.resize(
-                    project=gcp_project,
-                    zone=gcpzone,
-                    disk=disk_name,
-                    disks_resize_request_resource=DisksResizeRequest(
-                        size_gb=new_disk_size
-                    ),
+                ops.append(
+                    disk_client.resize(
+                        project=gcp_project,
+                        zone=gcpzone,
+                        disk=disk_name,
+                        disks_resize_request_resource=DisksResizeRequest(
+                            size_gb=new_disk_size
+                        ),
+                    )
                 )
-                wait_for_extended_operation(op)
-                logger.info(f"Resized {instance_id}")
+
+        operations.check(ops)
+        logger.info(f"Resized {instance_id}")
 
     except Exception as e:
-        update_errors(e)
+        ctx.add_error(e)
 
 
 def resize_azure_vm(
+    ctx: RunContext,
     deployment_id: str,
     cluster_name: str,
     group: dict,
@@ -214,9 +229,7 @@ def resize_azure_vm(
     logger.debug("++azure %s %s %s" % (cluster_name, group["group_name"], x))
 
     try:
-        # Acquire a credential object using CLI-based authentication.
-        credential = EnvironmentCredential()
-        client = ComputeManagementClient(credential, azure_subscription_id)
+        client = azure_compute_client(azure_subscription_id)
 
         instance_name = deployment_id + "-" + str(random.randint(0, 1e16)).zfill(16)
 
@@ -369,4 +382,4 @@ def resize_azure_vm(
 
     except Exception as e:
         logger.error(e)
-        update_errors(e)
+        ctx.add_error(e)
@@ -4,19 +4,34 @@ import logging
 logger = logging.getLogger("cloud_instance")
 
 
-from ..util.build import build
+from ..util.build import build, get_deployment_clouds, get_deployment_regions
 from ..util.fetch import fetch
 
 
 def slated(
     deployment_id: str,
     deployment: list,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    clouds: list[str] | None = None,
 ) -> list[dict]:
 
-    logger.info(f"Fetching all instances with {deployment_id=}")
+    # a scope derived from the spec is remembered by the inventory cache,
+    # so a plain gather right after can be served from it
+    from_spec = regions is None and clouds is None
+
+    if regions is None:
+        regions = get_deployment_regions(deployment, "aws")
+
+    if clouds is None:
+        clouds = get_deployment_clouds(deployment)
+
+    logger.info(f"Fetching all instances with {deployment_id=} {regions=} {clouds=}")
 
     try:
-        current_instances = fetch(deployment_id)
+        current_instances = fetch(
+            deployment_id, regions, refresh, clouds=clouds, from_spec=from_spec
+        )
     except:
         raise ValueError(f"Failed to fetch instances for {deployment_id=}")
 
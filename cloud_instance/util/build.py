@@ -1,12 +1,9 @@
 import logging
-from threading import Lock, Thread
 
 from .provision import provision_aws_vm, provision_azure_vm, provision_gcp_vm
 
 logger = logging.getLogger("cloud_instance")
 
-current_instances: list[dict] = []
-
 
 def build(
     deployment_id: str,
@@ -20,8 +17,8 @@ def build(
     surplus_vms = []
     current_vms = []
 
-    global current_instances
-    current_instances = _current_instances
+    # the instances not claimed by any group are left over as surplus
+    current_instances = list(_current_instances)
 
     # loop through each cluster item in the deployment list
     for cluster in deployment:
@@ -33,6 +30,7 @@ def build(
                 f"{cluster_name}-{x}",
                 cluster,
                 deployment_id,
+                current_instances,
             )
             new_vms += _new_vms
             surplus_vms += _surplus_vms
@@ -45,6 +43,7 @@ def build_cluster(
     cluster_name: str,
     cluster: dict,
     deployment_id,
+    current_instances: list[dict],
 ):
     # for each group in the cluster,
     # put all cluster defaults into the group
@@ -57,6 +56,7 @@ def build_cluster(
             cluster_name,
             merge_dicts(cluster, group),
             deployment_id,
+            current_instances,
         )
         new_vms += _new_vms
         surplus_vms += _surplus_vms
@@ -69,13 +69,15 @@ def build_group(
     cluster_name: str,
     group: dict,
     deployment_id,
+    current_instances: list[dict],
 ):
     # for each group, compare what is in 'deployment' to what is in 'current_deployment':
     #     case NO DIFFERENCE
     #       return the details in current_deployment
     #
     #     case TOO FEW
-    #       for each exact count, start a thread to create the requested instance
+    #       for each exact count, return the (target, args) of a thread creating
+    #       the requested instance, or of one thread for the whole batch on AWS and GCP
     #       return current_deployment + the details of the newly created instances
     #
     #     case TOO MANY
@@ -87,8 +89,6 @@ def build_group(
     new_vms = []
     surplus_vms = []
 
-    global current_instances
-
     for x in current_instances.copy():
         if (
             x["cluster_name"] == cluster_name
@@ -103,17 +103,27 @@ def build_group(
     new_exact_count = int(group.get("exact_count", 0))
 
     # ADD instances
-    if current_count < new_exact_count:
+    if current_count < new_exact_count and group["cloud"] in ("aws", "gcp"):
+        # AWS and GCP launch the whole batch with one request
+        new_vms.append(
+            (
+                {
+                    "aws": provision_aws_vm,
+                    "gcp": provision_gcp_vm,
+                }.get(group["cloud"]),
+                (
+                    deployment_id,
+                    cluster_name,
+                    group,
+                    new_exact_count - current_count,
+                ),
+            )
+        )
+
+    elif current_count < new_exact_count:
         for x in range(new_exact_count - current_count):
             new_vms.append(
-                Thread(
-                    target={
-                        "aws": provision_aws_vm,
-                        "gcp": provision_gcp_vm,
-                        "azure": provision_azure_vm,
-                    }.get(group["cloud"]),
-                    args=(deployment_id, cluster_name, group, x),
-                )
+                (provision_azure_vm, (deployment_id, cluster_name, group, x))
             )
 
     # REMOVE instances
@@ -124,6 +134,43 @@ def build_group(
     return current_group, surplus_vms, new_vms
 
 
+def get_deployment_regions(deployment: list[dict], cloud: str) -> list[str]:
+    # the regions of all groups in the deployment that belong to `cloud`
+    regions = set()
+
+    for cluster in deployment:
+        for group in cluster.get("groups", []):
+            if get_group_value(cluster, group, "cloud") == cloud:
+                region = get_group_value(cluster, group, "region")
+                if region:
+                    regions.add(region)
+
+    return sorted(regions)
+
+
+def get_deployment_clouds(deployment: list[dict]) -> list[str]:
+    # the providers used by any group in the deployment
+    clouds = set()
+
+    for cluster in deployment:
+        for group in cluster.get("groups", []):
+            cloud = get_group_value(cluster, group, "cloud")
+            if cloud:
+                clouds.add(cloud)
+
+    return sorted(clouds)
+
+
+def get_group_value(parent: dict, child: dict, key: str):
+    # what merge_dicts would resolve `key` to, without merging: merge_dicts
+    # updates the parent's tags, so it must only run once per group, in build
+    for x in (child, child.get("import", {}), parent, parent.get("import", {})):
+        if key in x:
+            return x[key]
+
+    return None
+
+
 def merge_dicts(parent: dict, child: dict):
     merged = {}
 
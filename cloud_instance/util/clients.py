@@ -0,0 +1,138 @@
+import logging
+import os
+import time
+from threading import Lock, RLock
+from typing import Callable
+
+from .common import MAX_WORKERS
+
+logger = logging.getLogger("cloud_instance")
+
+# seconds before expiry at which a shared Azure token is renewed
+AZURE_TOKEN_REFRESH_MARGIN = int(os.getenv("CLOUD_INSTANCE_AZURE_TOKEN_MARGIN", 300))
+
+# SDK clients are built once and shared by every thread for the life of the
+# process, so each (service, region) pays for its setup and connection pool once.
+# Reentrant, as some factories need other shared clients
+clients: dict = {}
+clients_lock = RLock()
+
+aws_session = None
+gcp_credentials = None
+
+
+def get_client(key: tuple, factory: Callable):
+    with clients_lock:
+        if key not in clients:
+            logger.debug(f"Creating client {key}")
+            clients[key] = factory()
+        return clients[key]
+
+
+def aws_client(service: str, region: str):
+    # botocore clients are thread-safe, sessions are not:
+    # they are only touched while holding clients_lock
+    def factory():
+        import boto3
+        from botocore.config import Config
+
+        global aws_session
+        if aws_session is None:
+            aws_session = boto3.session.Session()
+
+        # no retries in botocore: every call goes through throttle.call, which
+        # retries throttling and transient errors itself. Retrying here as
+        # well would hide throttling from its buckets and multiply attempts
+        return aws_session.client(
+            service,
+            region_name=region,
+            config=Config(
+                max_pool_connections=MAX_WORKERS,
+                retries={"mode": "standard", "max_attempts": 1},
+            ),
+        )
+
+    return get_client(("aws", service, region), factory)
+
+
+def gcp_client(name: str):
+    """
+    Return the shared `google.cloud.compute_v1` client called `name`,
+    eg "InstancesClient".
+
+    Every GCP client is built on the same credentials, discovered once,
+    so their access token is fetched and refreshed once for the process.
+    """
+
+    def factory():
+        import google.auth
+        from google.cloud import compute_v1
+
+        global gcp_credentials
+        if gcp_credentials is None:
+            gcp_credentials, _ = google.auth.default(
+                scopes=["https://www.googleapis.com/auth/cloud-platform"]
+            )
+
+        return getattr(compute_v1, name)(credentials=gcp_credentials)
+
+    return get_client(("gcp", name), factory)
+
+
+class AzureCredential:
+    """
+    Wrap an azure-identity credential so that every client and thread shares
+    one token per scope, renewed `margin` seconds before it expires rather
+    than when a request first fails.
+    """
+
+    def __init__(self, credential, margin: int = AZURE_TOKEN_REFRESH_MARGIN):
+        self.credential = credential
+        self.margin = margin
+        self.tokens: dict = {}
+        self.lock = Lock()
+
+    def get_token(self, *scopes, **kwargs):
+        # claims challenges must always go to the identity provider
+        if kwargs.get("claims"):
+            return self.credential.get_token(*scopes, **kwargs)
+
+        key = (scopes, kwargs.get("tenant_id"))
+
+        with self.lock:
+            token = self.tokens.get(key)
+            if token is None or token.expires_on - self.margin <= time.time():
+                logger.debug(f"Acquiring Azure token for {scopes}")
+                token = self.credential.get_token(*scopes, **kwargs)
+                self.tokens[key] = token
+            return token
+
+    def close(self):
+        self.credential.close()
+
+
+def azure_credential() -> AzureCredential:
+    def factory():
+        from azure.identity import EnvironmentCredential
+
+        return AzureCredential(EnvironmentCredential())
+
+    return get_client(("azure", "credential"), factory)
+
+
+def azure_compute_client(subscription_id: str):
+    def factory():
+        from azure.mgmt.compute import ComputeManagementClient
+
+        return ComputeManagementClient(azure_credential(), subscription_id)
+
+    return get_client(("azure", "compute", subscription_id), factory)
+
+
+def azure_network_client(subscription_id: str):
+    def factory():
+        from azure.mgmt.network import NetworkManagementClient
+
+        return NetworkManagementClient(azure_credential(), subscription_id)
+
+    return get_client(("azure", "network", subscription_id), factory)
@@ -1,15 +1,50 @@
+import json
 import logging
+import os
+import tempfile
+from contextlib import suppress
+from typing import TYPE_CHECKING
 
-from google.api_core.extended_operation import ExtendedOperation
+if TYPE_CHECKING:
+    from google.api_core.extended_operation import ExtendedOperation
 
 logger = logging.getLogger("cloud_instance")
 
+# upper bound on the number of concurrent threads used to fan out API calls
+MAX_WORKERS = int(os.getenv("CLOUD_INSTANCE_MAX_WORKERS", 16))
 
-def wait_for_extended_operation(op: ExtendedOperation):
-    result = op.result(timeout=300)
 
-    if op.error_code:
-        logger.error(f"GCP Error: {op.error_code}: {op.error_message}")
-        raise ValueError(f"GCP Error: {op.error_code}: {op.error_message}")
+def get_cache_dir() -> str:
+    path = os.getenv(
+        "CLOUD_INSTANCE_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "cloud_instance"),
+    )
+    os.makedirs(path, exist_ok=True)
+    return path
 
-    return result
+
+def write_json(path: str, data) -> None:
+    # write to a temp file of our own, then rename it over `path`: readers
+    # never see a partial file and concurrent writers never share a temp file
+    f = tempfile.NamedTemporaryFile(
+        "w",
+        dir=os.path.dirname(path) or ".",
+        prefix=os.path.basename(path) + ".",
+        suffix=".tmp",
+        delete=False,
+    )
+    try:
+        with f:
+            json.dump(data, f)
+        os.replace(f.name, path)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(f.name)
+        raise
+
+
+def wait_for_extended_operation(op: "ExtendedOperation"):
+    # polled by the shared tracker together with every other pending operation
+    from .operations import check
+
+    check([op])
@@ -0,0 +1,41 @@
+import logging
+from threading import Lock
+from typing import Callable
+
+logger = logging.getLogger("cloud_instance")
+
+
+class RunContext:
+    """
+    The state of one run of an operation: the instances it produced, the
+    errors its threads hit and the instance type defaults it was given.
+
+    Every fetch, provision, terminate, modify and resize creates its own and
+    hands it to its worker threads, so any number of runs can be in flight
+    in the same process.
+    """
+
+    def __init__(
+        self,
+        defaults: dict | None = None,
+        on_instances: Callable[[list[dict]], None] | None = None,
+    ):
+        self.instances: list[dict] = []
+        self.errors: list = []
+        self.defaults = defaults if defaults is not None else {}
+        # called with every batch of instances as soon as it is added
+        self.on_instances = on_instances
+        self.lock = Lock()
+
+    def add_instances(self, instances: list[dict]):
+        with self.lock:
+            logger.debug("Updating instances list")
+            self.instances += instances
+
+        if self.on_instances:
+            self.on_instances(instances)
+
+    def add_error(self, error):
+        logger.error(error)
+        with self.lock:
+            self.errors.append(error)
@@ -1,229 +1,413 @@
+import json
 import logging
 import os
-from threading import Lock, Thread
-
-# AWS
-import boto3
-
-# AZURE
-from azure.identity import EnvironmentCredential
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.network import NetworkManagementClient
-
-# GCP
-from google.cloud.compute_v1 import AggregatedListInstancesRequest, InstancesClient
-
-from .parse import parse_aws_query, parse_azure_query, parse_gcp_query
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from typing import Callable
+
+from . import inventory, throttle
+from .clients import (
+    aws_client,
+    azure_compute_client,
+    azure_network_client,
+    gcp_client,
+)
+from .common import MAX_WORKERS, get_cache_dir, write_json
+from .context import RunContext
+from .parse import iter_aws_query, parse_azure_query, parse_gcp_query
 
 logger = logging.getLogger("cloud_instance")
 
-instances: list[dict] = []
-errors: list[str] = []
-
+# seconds the cached catalog of enabled AWS regions is considered valid
+AWS_REGIONS_TTL = int(os.getenv("CLOUD_INSTANCE_AWS_REGIONS_TTL", 86400))
+
+# instances per describe_instances page, between 5 and 1000
+AWS_PAGE_SIZE = int(os.getenv("CLOUD_INSTANCE_AWS_PAGE_SIZE", 1000))
+
+# instances per aggregated list page, at most 500
+GCP_PAGE_SIZE = int(os.getenv("CLOUD_INSTANCE_GCP_PAGE_SIZE", 500))
+
+# partial response: only the fields parse_gcp_query reads, plus the page token
+GCP_FIELDS = (
+    "nextPageToken,"
+    "items/*/instances(name,zone,status,labels,metadata/items,"
+    "networkInterfaces(networkIP,accessConfigs/natIP))"
+)
+
+
+def fetch(
+    deployment_id: str,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    listener: Callable[[list[dict]], None] | None = None,
+    clouds: list[str] | None = None,
+    from_spec: bool = False,
+    trust_spec: bool = False,
+):
+    """
+    Fetch all running instances tagged with `deployment_id`.
+
+    `regions` restricts the AWS region fan-out to the given regions;
+    `None` searches every enabled region, an empty list skips AWS entirely.
+    `clouds` restricts the fetch to the given providers, the others are never
+    imported, authenticated or queried; `None` means every provider.
+    Results are served from the inventory cache while fresh, unless `refresh`.
+    `from_spec` marks `regions` and `clouds` as derived from the deployment
+    spec, so the cached result also serves later unscoped fetches that
+    `trust_spec`.
+    """
+    return fetch_many(
+        [deployment_id], None, regions, refresh, listener, clouds, from_spec, trust_spec
+    )[deployment_id]
+
+
+def fetch_many(
+    deployment_ids: list[str] | None,
+    prefix: str | None = None,
+    regions: list[str] | None = None,
+    refresh: bool = False,
+    listener: Callable[[list[dict]], None] | None = None,
+    clouds: list[str] | None = None,
+    from_spec: bool = False,
+    trust_spec: bool = False,
+) -> dict[str, list[dict]]:
+    """
+    Fetch the instances of several deployments in a single sweep.
+
+    Selects every deployment in `deployment_ids` plus, if given, every
+    deployment whose id starts with `prefix`. Each cloud is queried once for
+    the whole selection and the result is split by deployment_id locally.
+
+    `listener` receives each batch of instances as soon as a region or zone
+    page is parsed, before the slower ones have answered.
+    """
+    deployment_ids = deployment_ids or []
 
-def fetch(deployment_id: str):
     threads: list[Thread] = []
-    global instances
-    global errors
+
+    # the cache can only answer for deployments known by name
+    if not refresh and not prefix:
+        cached = {
+            x: inventory.get(x, regions, clouds, trust_spec=trust_spec)
+            for x in deployment_ids
+        }
+        if all(x is not None for x in cached.values()):
+            logger.info(f"Using cached inventory for {deployment_ids=}")
+            if listener:
+                for x in cached.values():
+                    listener(x)
+            return cached
+
+    on_instances = None
+    if listener:
+        on_instances = lambda _instances: listener(
+            [
+                x
+                for x in _instances
+                if is_selected(x["deployment_id"], deployment_ids, prefix)
+            ]
+        )
+
+    ctx = RunContext(on_instances=on_instances)
 
     # AWS
-    thread = Thread(target=fetch_aws_instances, args=(deployment_id,))
-    thread.start()
-    threads.append(thread)
+    if clouds is None or "aws" in clouds:
+        thread = Thread(
+            target=fetch_aws_instances,
+            args=(ctx, deployment_ids, prefix, regions),
+        )
+        thread.start()
+        threads.append(thread)
 
     # GCP
-    thread = Thread(
-        target=fetch_gcp_instances,
-        args=(deployment_id,),
-    )
-    thread.start()
-    threads.append(thread)
+    if clouds is None or "gcp" in clouds:
+        thread = Thread(
+            target=fetch_gcp_instances,
+            args=(ctx, deployment_ids, prefix),
+        )
+        thread.start()
+        threads.append(thread)
 
     # AZURE
-    # if azure_resource_group:
-    #     thread = Thread(
-    #         target=fetch_azure_instances, args=(deployment_id,)
-    #     )
-    #     thread.start()
-    #     threads.append(thread)
+    if (clouds is None and os.getenv("AZURE_RESOURCE_GROUP")) or (
+        clouds is not None and "azure" in clouds
+    ):
+        thread = Thread(
+            target=fetch_azure_instances,
+            args=(ctx, deployment_ids, prefix),
+        )
+        thread.start()
+        threads.append(thread)
 
     # wait for all threads to complete
     for x in threads:
         x.join()
 
     # sort instances to ensure list is deterministic
-    instances = sorted(instances, key=lambda d: d["id"])
+    instances = sorted(ctx.instances, key=lambda d: d["id"])
 
-    if errors:
-        raise ValueError(f"Failed to fetch resources for {deployment_id=}")
+    if ctx.errors:
+        raise ValueError(
+            f"Failed to fetch resources for {deployment_ids=} {prefix=}: "
+            + "; ".join(str(x) for x in ctx.errors)
+        )
 
-    return instances
+    # split per deployment. Server-side filters can be looser than the
+    # selection (eg GCP prefix is a substring match), so check again here
+    result: dict[str, list[dict]] = {x: [] for x in deployment_ids}
+    for x in instances:
+        if is_selected(x["deployment_id"], deployment_ids, prefix):
+            result.setdefault(x["deployment_id"], []).append(x)
 
+    for k, v in result.items():
+        inventory.put(k, regions, clouds, v, from_spec)
 
-def update_instances_list(_instances: list):
-    global instances
-    with Lock():
-        logger.debug("Updating instances list")
-        instances += _instances
+    return result
 
 
-def update_errors(error: str):
-    global errors
-    logger.error(error)
-    with Lock():
-        errors.append(error)
+def is_selected(
+    deployment_id: str,
+    deployment_ids: list[str],
+    prefix: str | None,
+) -> bool:
+    return deployment_id in deployment_ids or bool(
+        prefix and deployment_id.startswith(prefix)
+    )
 
 
-def fetch_aws_instances(deployment_id: str):
-    logger.debug(f"Fetching AWS instances for deployment_id = '{deployment_id}'")
+def get_aws_regions() -> list[str]:
+    # return the enabled AWS regions, using the on-disk catalog while fresh
+    try:
+        with open(os.path.join(get_cache_dir(), "aws_regions.json")) as f:
+            catalog = json.load(f)
+        if time.time() - catalog["ts"] < AWS_REGIONS_TTL:
+            return catalog["regions"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    logger.debug("Refreshing AWS regions catalog")
+    ec2 = aws_client("ec2", "us-east-1")
+    response = throttle.call("aws", "us-east-1", "describe", ec2.describe_regions)
+    regions = [x["RegionName"] for x in response["Regions"]]
 
-    threads: list[Thread] = []
+    try:
+        write_json(
+            os.path.join(get_cache_dir(), "aws_regions.json"),
+            {"ts": time.time(), "regions": regions},
+        )
+    except OSError as e:
+        logger.warning(f"Could not write AWS regions catalog: {e}")
+
+    return regions
+
+
+def fetch_aws_instances(
+    ctx: RunContext,
+    deployment_ids: list[str],
+    prefix: str | None = None,
+    regions: list[str] | None = None,
+):
+    logger.debug(f"Fetching AWS instances for {deployment_ids=} {prefix=}")
 
-    def fetch_aws_instances_per_region(region, deployment_id):
+    # tag filters accept multiple values and '*' wildcards
+    tag_values = deployment_ids + ([f"{prefix}*"] if prefix else [])
+
+    if regions is not None and not regions:
+        logger.debug("No AWS regions to search, skipping AWS")
+        return
+
+    def fetch_aws_instances_per_region(region):
         logger.debug(f"Fetching AWS instances from {region}")
 
         try:
-            ec2 = boto3.client("ec2", region_name=region)
-            response = ec2.describe_instances(
-                Filters=[
+            ec2 = aws_client("ec2", region)
+
+            kwargs = {
+                "Filters": [
                     {
                         "Name": "instance-state-name",
                         "Values": ["pending", "running"],
                     },
-                    {"Name": "tag:deployment_id", "Values": [deployment_id]},
-                ]
-            )
+                    {"Name": "tag:deployment_id", "Values": tag_values},
+                ],
+                "MaxResults": AWS_PAGE_SIZE,
+            }
 
-            aws_instances: list = parse_aws_query(response)
+            # parse and publish each page as it arrives. Paged by hand so
+            # every page request goes through the rate limiter
+            while True:
+                page = throttle.call(
+                    "aws", region, "describe", ec2.describe_instances, **kwargs
+                )
 
-        except Exception as e:
-            update_errors(e)
+                aws_instances: list = list(iter_aws_query(page))
 
-        if aws_instances:
-            update_instances_list(aws_instances)
+                if aws_instances:
+                    ctx.add_instances(aws_instances)
 
-    try:
-        ec2 = boto3.client("ec2", region_name="us-east-1")
-        regions = [x["RegionName"] for x in ec2.describe_regions()["Regions"]]
-
-        for region in regions:
-            thread = Thread(
-                target=fetch_aws_instances_per_region,
-                args=(region, deployment_id),
-                daemon=True,
-            )
-            thread.start()
-            threads.append(thread)
+                if not page.get("NextToken"):
+                    break
+                kwargs["NextToken"] = page["NextToken"]
 
-        for x in threads:
-            x.join()
+        except Exception as e:
+            ctx.add_error(e)
+
+    try:
+        enabled_regions = get_aws_regions()
+
+        if regions is None:
+            regions = enabled_regions
+        else:
+            # only search the hinted regions that can actually hold instances
+            for x in set(regions) - set(enabled_regions):
+                logger.warning(f"AWS region {x} is not enabled, skipping")
+            regions = sorted(set(regions) & set(enabled_regions))
+
+        if not regions:
+            return
+
+        with ThreadPoolExecutor(
+            max_workers=min(MAX_WORKERS, len(regions)),
+            thread_name_prefix="fetch-aws",
+        ) as pool:
+            for region in regions:
+                pool.submit(fetch_aws_instances_per_region, region)
 
     except Exception as e:
-        update_errors(e)
+        ctx.add_error(e)
 
 
-def fetch_gcp_instances(deployment_id: str):
-    logger.debug(f"Fetching GCP instances for deployment_id = '{deployment_id}'")
+def fetch_gcp_instances(
+    ctx: RunContext, deployment_ids: list[str], prefix: str | None = None
+):
+    logger.debug(f"Fetching GCP instances for {deployment_ids=} {prefix=}")
+
+    # GCP
+    from google.cloud.compute_v1 import AggregatedListInstancesRequest
 
     gcp_project = os.getenv("GCP_PROJECT")
     if not gcp_project:
-        update_errors("Env var GCP_PROJECT is not set")
+        ctx.add_error("Env var GCP_PROJECT is not set")
         return
 
     try:
-        instance_client = InstancesClient()
-        # Use the `max_results` parameter to limit the number of results that the API returns per response page.
+        instance_client = gcp_client("InstancesClient")
+
+        # one combined label filter for all selected deployments.
+        # ':' is a substring match, the prefix is enforced after the fetch
+        selectors = [f'(labels.deployment_id = "{x}")' for x in deployment_ids]
+        if prefix:
+            selectors.append(f'(labels.deployment_id:"{prefix}")')
+
+        # filter by deployment and status server-side
         request = AggregatedListInstancesRequest(
             project=gcp_project,
-            max_results=5,
-            filter=f"labels.deployment_id:{deployment_id}",
+            max_results=GCP_PAGE_SIZE,
+            filter=(
+                f"({' OR '.join(selectors)}) AND "
+                '((status = "PROVISIONING") OR (status = "STAGING") OR (status = "RUNNING"))'
+            ),
         )
 
-        agg_list = instance_client.aggregated_list(request=request)
-        instances = []
-
-        # Despite using the `max_results` parameter, you don't need to handle the pagination
-        # your The returned `AggregatedListPager` object handles pagination
+        # the returned `AggregatedListPager` object handles pagination
         # automatically, returning separated pages as you iterate over the results.
+        agg_list = instance_client.aggregated_list(
+            request=request,
+            metadata=[("x-goog-fieldmask", GCP_FIELDS)],
+        )
+
         for zone, response in agg_list:
             if response.instances:
-                for x in response.instances:
-                    if x.status in ("PROVISIONING", "STAGING", "RUNNING"):
-                        instances.append(parse_gcp_query(x, zone[6:-2], zone[-1]))
-
-        if instances:
-            update_instances_list(instances)
+                ctx.add_instances(
+                    [
+                        parse_gcp_query(x, zone[6:-2], zone[-1])
+                        for x in response.instances
+                    ]
+                )
 
     except Exception as e:
-        update_errors(e)
-
+        ctx.add_error(e)
 
-"""
-def fetch_azure_instance_network_config(self, vm):
-    try:
-        credential = EnvironmentCredential()
-
-        client = ComputeManagementClient(credential, azure_subscription_id)
-        netclient = NetworkManagementClient(credential, azure_subscription_id)
 
-        # check VM is in running state
-        statuses = client.virtual_machines.instance_view(
-            azure_resource_group, vm.name
-        ).statuses
+def fetch_azure_instances(
+    ctx: RunContext, deployment_ids: list[str], prefix: str | None = None
+):
+    logger.debug(f"Fetching Azure instances for {deployment_ids=} {prefix=}")
 
-        status = len(statuses) >= 2 and statuses[1]
-
-        if status and status.code == "PowerState/running":
-            nic_id = vm.network_profile.network_interfaces[0].id
-            nic = netclient.network_interfaces.get(
-                azure_resource_group, nic_id.split("/")[-1]
-            )
+    azure_subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
+    azure_resource_group = os.getenv("AZURE_RESOURCE_GROUP")
 
-            private_ip = nic.ip_configurations[0].private_ip_address
-            pip = netclient.public_ip_addresses.get(
-                azure_resource_group,
-                nic.ip_configurations[0].public_ip_address.id.split("/")[-1],
+    try:
+        client = azure_compute_client(azure_subscription_id)
+        netclient = azure_network_client(azure_subscription_id)
+
+        # list everything once per resource group and join locally by resource id,
+        # so the number of calls doesn't grow with the number of VMs
+        vms = [
+            vm
+            for vm in client.virtual_machines.list(azure_resource_group)
+            if is_selected(
+                (vm.tags or {}).get("deployment_id", ""), deployment_ids, prefix
             )
-
-            public_ip = pip.ip_address
+        ]
+
+        if not vms:
+            return
+
+        # the power state of every VM in a single call: instanceView can only
+        # be expanded on list() together with a VMSS filter. The subscription
+        # wide list is narrowed down to our VMs locally
+        ids = {vm.id.lower() for vm in vms}
+        statuses = {
+            x.id.lower(): x.instance_view.statuses if x.instance_view else []
+            for x in client.virtual_machines.list_all(status_only="true")
+            if x.id.lower() in ids
+        }
+
+        nics = {
+            x.id.lower(): x
+            for x in netclient.network_interfaces.list(azure_resource_group)
+        }
+        pips = {
+            x.id.lower(): x
+            for x in netclient.public_ip_addresses.list(azure_resource_group)
+        }
+
+        azure_instances = []
+
+        for vm in vms:
+            # check VM is in running state
+            codes = [x.code for x in statuses.get(vm.id.lower(), [])]
+            if "PowerState/running" in codes:
+                state = "running"
+            elif "PowerState/starting" in codes:
+                state = "pending"
+            else:
+                continue
+
+            nic = nics[vm.network_profile.network_interfaces[0].id.lower()]
+            ip_config = nic.ip_configurations[0]
+
+            public_ip = ""
             public_hostname = ""
-
-        return private_ip, public_ip, public_hostname
-
-    except Exception as e:
-        logger.error(e)
-        log_error(e)
-
-def get_azure_instance_details(self, vm):
-    update_current_deployment(
-        parse_azure_query(vm, *fetch_azure_instance_network_config(vm))
-    )
-
-def fetch_azure_instances(self, deployment_id: str):
-    logger.debug(f"Fetching Azure instances for deployment_id = '{deployment_id}'")
-
-    threads: list[Thread] = []
-
-    try:
-        # Acquire a credential object.
-        credential = EnvironmentCredential()
-
-    except Exception as e:
-        logger.warning(e)
-        return
-
-    client = ComputeManagementClient(credential, azure_subscription_id)
-
-    vm_list = client.virtual_machines.list(azure_resource_group)
-    for vm in vm_list:
-        if vm.tags.get("deployment_id", "") == deployment_id:
-            thread = Thread(
-                target=get_azure_instance_details, args=(vm,), daemon=True
+            if ip_config.public_ip_address:
+                pip = pips.get(ip_config.public_ip_address.id.lower())
+                if pip:
+                    public_ip = pip.ip_address
+                    if pip.dns_settings:
+                        public_hostname = pip.dns_settings.fqdn
+
+            azure_instances += parse_azure_query(
+                vm,
+                ip_config.private_ip_address,
+                public_ip,
+                public_hostname,
+                state,
             )
-            thread.start()
-            threads.append(thread)
 
-    for x in threads:
-        x.join()
+        if azure_instances:
+            ctx.add_instances(azure_instances)
 
-"""
+    except Exception as e:
+        ctx.add_error(e)
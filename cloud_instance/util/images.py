@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+from . import throttle
+from .clients import aws_client, azure_compute_client, gcp_client
+from .common import get_cache_dir, write_json
+
+logger = logging.getLogger("cloud_instance")
+
+# seconds a resolved image id is reused from the on-disk cache, 0 disables it
+IMAGES_TTL = int(os.getenv("CLOUD_INSTANCE_IMAGES_TTL", 3600))
+
+# seconds a resolved image id is reused in memory. Bounded even with the disk
+# cache disabled, as a daemon keeps the process alive across runs
+MEMORY_TTL = IMAGES_TTL if IMAGES_TTL > 0 else 300
+
+# (cloud, region, image, arch) -> (concrete image id, resolution time)
+resolved: dict[tuple, tuple[str, float]] = {}
+resolved_lock = Lock()
+
+# one lock per key, so concurrent groups using the same image resolve it once
+key_locks: dict[tuple, Lock] = {}
+
+# serializes rewrites of the on-disk cache within this process
+file_lock = Lock()
+
+
+def resolve(cloud: str, region: str, image: str, arch: str = "amd64") -> str:
+    """
+    Return the concrete image id that `image` points to right now.
+
+    AWS images are SSM public parameter paths, GCP images can name a family
+    and Azure URNs can ask for the "latest" version. The result is what gets
+    passed to the create call, so every VM of a group boots the same image
+    even if a new one is published meanwhile.
+    """
+    key = (cloud, region, image, arch)
+
+    with resolved_lock:
+        image_id = get_resolved(key)
+        if image_id:
+            return image_id
+        key_lock = key_locks.setdefault(key, Lock())
+
+    with key_lock:
+        with resolved_lock:
+            image_id = get_resolved(key)
+            if image_id:
+                return image_id
+
+        image_id = load(key)
+
+        if image_id is None:
+            logger.debug(f"Resolving image {key}")
+            image_id = {
+                "aws": resolve_aws_image,
+                "gcp": resolve_gcp_image,
+                "azure": resolve_azure_image,
+            }[cloud](region, image, arch)
+            save(key, image_id)
+
+        logger.info(f"Image {image} resolved to {image_id}")
+
+        with resolved_lock:
+            resolved[key] = (image_id, time.time())
+
+    return image_id
+
+
+def get_resolved(key: tuple) -> str | None:
+    # callers hold resolved_lock
+    if key in resolved and time.time() - resolved[key][1] < MEMORY_TTL:
+        return resolved[key][0]
+    return None
+
+
+def resolve_aws_image(region: str, image: str, arch: str) -> str:
+    return throttle.call(
+        "aws",
+        region,
+        "ssm",
+        aws_client("ssm", region).get_parameter,
+        Name=f"/aws/service{image}/stable/current/{arch}/hvm/ebs-gp3/ami-id",
+    )["Parameter"]["Value"]
+
+
+def resolve_gcp_image(region: str, image: str, arch: str) -> str:
+    # eg projects/ubuntu-os-cloud/global/images/family/ubuntu-2204-lts
+    if "/family/" not in image:
+        return image
+
+    project = image.split("projects/", 1)[1].split("/", 1)[0]
+    family = image.rsplit("/", 1)[1]
+
+    return (
+        gcp_client("ImagesClient")
+        .get_from_family(project=project, family=family)
+        .self_link
+    )
+
+
+def resolve_azure_image(region: str, image: str, arch: str) -> str:
+    # publisher:offer:sku:version
+    publisher, offer, sku, version = image.split(":")
+
+    if version != "latest":
+        return image
+
+    client = azure_compute_client(os.getenv("AZURE_SUBSCRIPTION_ID"))
+
+    versions = [
+        x.name
+        for x in client.virtual_machine_images.list(region, publisher, offer, sku)
+    ]
+    if not versions:
+        raise ValueError(f"No Azure image versions found for {image} in {region}")
+
+    # versions are dotted numbers, eg 22.04.202310100
+    latest = max(versions, key=lambda x: [int(y) for y in x.split(".")])
+
+    return ":".join([publisher, offer, sku, latest])
+
+
+def get_path() -> str:
+    return os.path.join(get_cache_dir(), "images.json")
+
+
+def load(key: tuple) -> str | None:
+    if IMAGES_TTL <= 0:
+        return None
+
+    try:
+        with open(get_path()) as f:
+            entry = json.load(f)["|".join(key)]
+        if time.time() - entry["ts"] < IMAGES_TTL:
+            return entry["id"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    return None
+
+
+def save(key: tuple, image_id: str) -> None:
+    if IMAGES_TTL <= 0:
+        return
+
+    try:
+        path = get_path()
+    except OSError as e:
+        logger.warning(f"Could not write images cache: {e}")
+        return
+
+    with file_lock:
+        try:
+            with open(path) as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            catalog = {}
+
+        # drop expired entries so the file doesn't grow forever
+        catalog = {
+            k: v for k, v in catalog.items() if time.time() - v["ts"] < IMAGES_TTL
+        }
+        catalog["|".join(key)] = {"id": image_id, "ts": time.time()}
+
+        try:
+            write_json(path, catalog)
+        except OSError as e:
+            logger.warning(f"Could not write images cache: {e}")
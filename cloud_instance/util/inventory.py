@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from .common import get_cache_dir
+
+logger = logging.getLogger("cloud_instance")
+
+# seconds a fetched deployment is served from the inventory cache, 0 disables it
+INVENTORY_TTL = int(os.getenv("CLOUD_INSTANCE_INVENTORY_TTL", 60))
+
+# bump when the schema changes, older cache files are simply discarded
+SCHEMA_VERSION = 4
+
+
+def connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(os.path.join(get_cache_dir(), "inventory.db"), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+
+    if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS deployments")
+            conn.execute("DROP TABLE IF EXISTS instances")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS deployments (
+            deployment_id TEXT PRIMARY KEY,
+            regions TEXT,
+            clouds TEXT,
+            -- 1 if regions and clouds were derived from the deployment spec
+            from_spec INTEGER NOT NULL DEFAULT 0,
+            fetched_at REAL NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS instances (
+            cloud TEXT NOT NULL,
+            id TEXT NOT NULL,
+            deployment_id TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (cloud, id)
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS instances_deployment_id ON instances (deployment_id)"
+    )
+    return conn
+
+
+def get(
+    deployment_id: str,
+    regions: list[str] | None = None,
+    clouds: list[str] | None = None,
+    ttl: int = INVENTORY_TTL,
+    trust_spec: bool = False,
+) -> list[dict] | None:
+    """
+    Return the cached instances of `deployment_id`, or None on a cache miss.
+
+    The entry only counts as a hit if it is younger than `ttl` and the fetch
+    that populated it covered every AWS region in `regions` and every
+    provider in `clouds`. With `trust_spec`, a fetch scoped by the
+    deployment spec, as create and slated do, also answers for `None`: the
+    spec says where the deployment lives. Only reads should trust it, a
+    delete must find instances the spec no longer mentions.
+    """
+    if ttl <= 0:
+        return None
+
+    try:
+        with connect() as conn:
+            row = conn.execute(
+                """
+                SELECT regions, clouds, from_spec, fetched_at
+                FROM deployments
+                WHERE deployment_id = ?
+                """,
+                (deployment_id,),
+            ).fetchone()
+
+            if not row or time.time() - row[3] >= ttl:
+                return None
+
+            from_spec = trust_spec and bool(row[2])
+            if not covers(json.loads(row[0]), regions, from_spec) or not covers(
+                json.loads(row[1]), clouds, from_spec
+            ):
+                return None
+
+            rows = conn.execute(
+                "SELECT data FROM instances WHERE deployment_id = ? ORDER BY id",
+                (deployment_id,),
+            ).fetchall()
+
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"Inventory cache unavailable: {e}")
+        return None
+
+    instances = [json.loads(x[0]) for x in rows]
+
+    if regions is not None:
+        instances = [
+            x for x in instances if x["cloud"] != "aws" or x["region"] in regions
+        ]
+
+    if clouds is not None:
+        instances = [x for x in instances if x["cloud"] in clouds]
+
+    return instances
+
+
+def covers(
+    cached: list[str] | None,
+    requested: list[str] | None,
+    from_spec: bool = False,
+) -> bool:
+    # None stands for "all of them", or for "all of the spec" if from_spec
+    if cached is None:
+        return True
+
+    if requested is None:
+        return bool(from_spec)
+
+    return set(requested).issubset(cached)
+
+
+def put(
+    deployment_id: str,
+    regions: list[str] | None,
+    clouds: list[str] | None,
+    instances: list[dict],
+    from_spec: bool = False,
+) -> None:
+    # replace the cached inventory of deployment_id with a fresh fetch result
+    try:
+        with connect() as conn:
+            conn.execute(
+                "DELETE FROM instances WHERE deployment_id = ?", (deployment_id,)
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?)",
+                [
+                    (x["cloud"], x["id"], deployment_id, json.dumps(x))
+                    for x in instances
+                ],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO deployments VALUES (?, ?, ?, ?, ?)",
+                (
+                    deployment_id,
+                    json.dumps(sorted(regions) if regions is not None else None),
+                    json.dumps(sorted(clouds) if clouds is not None else None),
+                    int(from_spec),
+                    time.time(),
+                ),
+            )
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"Could not update inventory cache: {e}")
+
+
+def add(deployment_id: str, instances: list[dict]) -> None:
+    # write newly created instances through to the cache
+    try:
+        with connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?)",
+                [
+                    (x["cloud"], x["id"], deployment_id, json.dumps(x))
+                    for x in instances
+                ],
+            )
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"Could not update inventory cache: {e}")
+
+
+def remove(instances: list[dict], invalidate: bool = False) -> None:
+    """
+    Drop `instances` from the cache.
+
+    With `invalidate`, the deployments they belong to are expired as well,
+    so the next fetch goes to the cloud APIs.
+    """
+    keys = [(x["cloud"], x["id"]) for x in instances]
+
+    try:
+        with connect() as conn:
+            if invalidate:
+                conn.executemany(
+                    """
+                    DELETE FROM deployments WHERE deployment_id IN (
+                        SELECT deployment_id FROM instances WHERE cloud = ? AND id = ?
+                    )
+                    """,
+                    keys,
+                )
+            conn.executemany("DELETE FROM instances WHERE cloud = ? AND id = ?", keys)
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"Could not update inventory cache: {e}")
+
+
+def invalidate(deployment_id: str) -> None:
+    try:
+        with connect() as conn:
+            conn.execute(
+                "DELETE FROM deployments WHERE deployment_id = ?", (deployment_id,)
+            )
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"Could not update inventory cache: {e}")
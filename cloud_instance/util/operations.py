@@ -0,0 +1,155 @@
+import logging
+import os
+from typing import TYPE_CHECKING
+
+from . import throttle
+from .clients import gcp_client
+from .tracker import Tracker
+
+if TYPE_CHECKING:
+    from google.api_core.extended_operation import ExtendedOperation
+
+logger = logging.getLogger("cloud_instance")
+
+# seconds between polls, see Tracker
+OPERATION_MIN_INTERVAL = float(os.getenv("CLOUD_INSTANCE_OPERATION_MIN_INTERVAL", 1))
+OPERATION_MAX_INTERVAL = float(os.getenv("CLOUD_INSTANCE_OPERATION_MAX_INTERVAL", 10))
+
+# seconds to wait for an operation before giving up
+OPERATION_TIMEOUT = int(os.getenv("CLOUD_INSTANCE_OPERATION_TIMEOUT", 300))
+
+# operation names OR-ed in a single list filter
+OPERATION_BATCH_SIZE = 50
+
+# scope -> name of the compute_v1 client listing its operations
+CLIENTS = {
+    "zones": "ZoneOperationsClient",
+    "regions": "RegionOperationsClient",
+    "global": "GlobalOperationsClient",
+}
+
+
+def get_key(op: "ExtendedOperation") -> tuple:
+    # (project, scope, location, name) from the self link, eg
+    # .../projects/my-project/zones/us-east1-b/operations/operation-123
+    parts = op.self_link.split("/projects/", 1)[1].split("/")
+
+    if parts[1] == "global":
+        return (parts[0], "global", None, parts[-1])
+
+    return (parts[0], parts[1], parts[2], parts[-1])
+
+
+class OperationTracker(Tracker):
+    """
+    Track every pending GCP operation of the process, zonal, regional or
+    global, and check them with one filtered list call per location and
+    tick, rather than blocking a thread on each operation.
+    """
+
+    def __init__(self):
+        super().__init__(
+            "gcp-operations", OPERATION_MIN_INTERVAL, OPERATION_MAX_INTERVAL
+        )
+
+    def wait(
+        self,
+        ops: list["ExtendedOperation"],
+        timeout: int = OPERATION_TIMEOUT,
+    ) -> list[str | None]:
+        keys = [get_key(x) for x in ops]
+
+        with self.track(keys):
+            self.cond.wait_for(lambda: all(x in self.results for x in keys), timeout)
+
+            return [
+                (
+                    self.results[x]
+                    if x in self.results
+                    else f"Timed out waiting for operation {x[3]}"
+                )
+                for x in keys
+            ]
+
+    def needs_poll(self, key: tuple) -> bool:
+        # done operations don't change anymore
+        return key not in self.results
+
+    def poll(self, keys: list[tuple]) -> dict[tuple, str | None]:
+        # key -> error message, or None on success, of the operations that are done
+        from google.cloud.compute_v1 import Operation
+
+        # group by location, so each list call covers many operations
+        groups: dict[tuple, list[str]] = {}
+        for project, scope, location, name in keys:
+            groups.setdefault((project, scope, location), []).append(name)
+
+        results = {}
+
+        for (project, scope, location), names in groups.items():
+            for i in range(0, len(names), OPERATION_BATCH_SIZE):
+                kwargs = {
+                    "project": project,
+                    "filter": " OR ".join(
+                        f'(name = "{x}")' for x in names[i : i + OPERATION_BATCH_SIZE]
+                    ),
+                }
+                if scope == "zones":
+                    kwargs["zone"] = location
+                elif scope == "regions":
+                    kwargs["region"] = location
+
+                try:
+                    response = throttle.call(
+                        "gcp",
+                        location or "global",
+                        "operations",
+                        gcp_client(CLIENTS[scope]).list,
+                        **kwargs,
+                    )
+                    for x in response:
+                        if x.status != Operation.Status.DONE:
+                            continue
+
+                        error = None
+                        if x.error and x.error.errors:
+                            error = "; ".join(
+                                f"{e.code}: {e.message}" for e in x.error.errors
+                            )
+                        elif x.http_error_status_code:
+                            error = (
+                                f"{x.http_error_status_code}: {x.http_error_message}"
+                            )
+
+                        if error:
+                            logger.error(f"GCP Error: {x.name}: {error}")
+                        results[(project, scope, location, x.name)] = error
+
+                except Exception as e:
+                    logger.warning(
+                        f"Listing GCP operations in {location or 'global'} failed: {e}"
+                    )
+
+        return results
+
+
+tracker = OperationTracker()
+
+
+def wait(
+    ops: list["ExtendedOperation"],
+    timeout: int = OPERATION_TIMEOUT,
+) -> list[str | None]:
+    """
+    Block until every operation in `ops` is done and return, for each one,
+    its error message or None if it succeeded.
+    """
+    return tracker.wait(ops, timeout)
+
+
+def check(ops: list["ExtendedOperation"], timeout: int = OPERATION_TIMEOUT) -> None:
+    # like wait, but raise if any of the operations failed
+    errors = [x for x in wait(ops, timeout) if x]
+
+    if errors:
+        raise ValueError(f"GCP Error: {'; '.join(errors)}")
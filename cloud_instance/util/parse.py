@@ -1,43 +1,48 @@
 import json
+from typing import TYPE_CHECKING
 
-from google.cloud.compute_v1.types import Instance
+if TYPE_CHECKING:
+    from google.cloud.compute_v1.types import Instance
 
 
 def parse_aws_query(ec2_response: dict):
-    instances: list[dict] = []
+    return list(iter_aws_query(ec2_response))
 
+
+def iter_aws_query(ec2_response: dict):
+    # yield one instance record at a time from a describe_instances response page
     for x in ec2_response["Reservations"]:
         for i in x["Instances"]:
             tags = {}
             for t in i["Tags"]:
                 tags[t["Key"]] = t["Value"]
 
-            instances.append(
-                {
-                    # cloud instance id, useful for deleting
-                    "id": i["InstanceId"],
-                    # locality
-                    "cloud": "aws",
-                    "region": i["Placement"]["AvailabilityZone"][:-1],
-                    "zone": i["Placement"]["AvailabilityZone"][-1],
-                    # addresses
-                    "public_ip": i["PublicIpAddress"],
-                    "public_hostname": i["PublicDnsName"],
-                    "private_ip": i["PrivateIpAddress"],
-                    "private_hostname": i["PrivateDnsName"],
-                    # tags
-                    "ansible_user": tags["ansible_user"],
-                    "inventory_groups": json.loads(tags["inventory_groups"]),
-                    "cluster_name": tags["cluster_name"],
-                    "group_name": tags["group_name"],
-                    "extra_vars": tags["extra_vars"],
-                }
-            )
-    return instances
+            yield {
+                # cloud instance id, useful for deleting
+                "id": i["InstanceId"],
+                # locality
+                "cloud": "aws",
+                "region": i["Placement"]["AvailabilityZone"][:-1],
+                "zone": i["Placement"]["AvailabilityZone"][-1],
+                # "pending" or "running"
+                "state": i["State"]["Name"],
+                # addresses
+                "public_ip": i["PublicIpAddress"],
+                "public_hostname": i["PublicDnsName"],
+                "private_ip": i["PrivateIpAddress"],
+                "private_hostname": i["PrivateDnsName"],
+                # tags
+                "deployment_id": tags["deployment_id"],
+                "ansible_user": tags["ansible_user"],
+                "inventory_groups": json.loads(tags["inventory_groups"]),
+                "cluster_name": tags["cluster_name"],
+                "group_name": tags["group_name"],
+                "extra_vars": tags["extra_vars"],
+            }
 
 
 def parse_gcp_query(
-    instance: Instance,
+    instance: "Instance",
     region,
     zone,
 ):
@@ -55,12 +60,15 @@ def parse_gcp_query(
         "cloud": "gcp",
         "region": region,
         "zone": zone,
+        # "pending" or "running"
+        "state": "running" if instance.status == "RUNNING" else "pending",
         # addresses
         "public_ip": instance.network_interfaces[0].access_configs[0].nat_i_p,
         "public_hostname": public_dns,
         "private_ip": instance.network_interfaces[0].network_i_p,
         "private_hostname": f"{instance.name}.c.cea-team.internal",
         # tags
+        "deployment_id": instance.labels["deployment_id"],
         "ansible_user": tags["ansible_user"],
         "inventory_groups": json.loads(tags["inventory_groups"]),
         "cluster_name": tags["cluster_name"],
@@ -69,7 +77,7 @@ def parse_gcp_query(
     }
 
 
-def parse_azure_query(vm, private_ip, public_ip, public_hostname):
+def parse_azure_query(vm, private_ip, public_ip, public_hostname, state="running"):
     return [
         {
             # cloud instance id, useful for deleting
@@ -78,12 +86,15 @@ def parse_azure_query(vm, private_ip, public_ip, public_hostname):
             "cloud": "azure",
             "region": vm.location,
             "zone": "default",
+            # "pending" or "running"
+            "state": state,
             # addresses
             "public_ip": public_ip,
             "public_hostname": public_hostname,
             "private_ip": private_ip,
             "private_hostname": vm.name + ".internal.cloudapp.net",
             # tags
+            "deployment_id": vm.tags["deployment_id"],
             "ansible_user": vm.tags["ansible_user"],
             "inventory_groups": json.loads(vm.tags["inventory_groups"]),
             "cluster_name": vm.tags["cluster_name"],
@@ -0,0 +1,110 @@
+import logging
+import os
+from threading import Lock
+
+from . import throttle
+from .clients import aws_client
+from .tracker import Tracker
+
+logger = logging.getLogger("cloud_instance")
+
+# seconds between polls, see Tracker
+POLL_MIN_INTERVAL = float(os.getenv("CLOUD_INSTANCE_POLL_MIN_INTERVAL", 2))
+POLL_MAX_INTERVAL = float(os.getenv("CLOUD_INSTANCE_POLL_MAX_INTERVAL", 15))
+
+# seconds to wait for a state before giving up, as the botocore waiters do
+POLL_TIMEOUT = int(os.getenv("CLOUD_INSTANCE_POLL_TIMEOUT", 600))
+
+# ids per describe call
+POLL_BATCH_SIZE = 200
+
+# states an instance can't get to the target state from, as in the botocore waiters
+FAILURE_STATES = {
+    "running": {"shutting-down", "terminated", "stopping"},
+    "stopped": {"pending", "terminated"},
+    "terminated": {"pending", "stopping"},
+}
+
+
+class RegionPoller(Tracker):
+    """
+    Track the state of every AWS instance someone is waiting on in a region
+    with one batched describe_instances per tick, instead of a waiter per
+    instance, and wake each waiter as soon as its instances get there.
+    """
+
+    def __init__(self, region: str):
+        super().__init__(f"poller-{region}", POLL_MIN_INTERVAL, POLL_MAX_INTERVAL)
+        self.region = region
+
+    def wait(self, instance_ids: list[str], state: str, timeout: int = POLL_TIMEOUT):
+        failures = FAILURE_STATES.get(state, set())
+
+        def done():
+            return all(self.results.get(x) == state for x in instance_ids) or any(
+                self.results.get(x) in failures for x in instance_ids
+            )
+
+        with self.track(instance_ids):
+            if not self.cond.wait_for(done, timeout):
+                raise ValueError(f"Timed out waiting for {instance_ids} to be {state}")
+
+            failed = {
+                x: self.results[x]
+                for x in instance_ids
+                if self.results.get(x) in failures
+            }
+            if failed:
+                raise ValueError(f"Instances can't become {state}: {failed}")
+
+    def poll(self, instance_ids: list[str]) -> dict[str, str]:
+        # instance id -> state
+        states = {}
+
+        try:
+            ec2 = aws_client("ec2", self.region)
+
+            for i in range(0, len(instance_ids), POLL_BATCH_SIZE):
+                # an id filter, unlike InstanceIds, doesn't fail on
+                # instances that aren't visible yet
+                response = throttle.call(
+                    "aws",
+                    self.region,
+                    "describe",
+                    ec2.describe_instances,
+                    Filters=[
+                        {
+                            "Name": "instance-id",
+                            "Values": instance_ids[i : i + POLL_BATCH_SIZE],
+                        }
+                    ],
+                )
+                for r in response["Reservations"]:
+                    for x in r["Instances"]:
+                        states[x["InstanceId"]] = x["State"]["Name"]
+
+        except Exception as e:
+            logger.warning(f"Polling AWS instances in {self.region} failed: {e}")
+            return {}
+
+        return states
+
+
+pollers: dict[str, RegionPoller] = {}
+pollers_lock = Lock()
+
+
+def wait(
+    region: str,
+    instance_ids: list[str],
+    state: str,
+    timeout: int = POLL_TIMEOUT,
+) -> None:
+    """
+    Block until all `instance_ids` in AWS `region` are in `state`,
+    eg "running", "stopped" or "terminated".
+    """
+    with pollers_lock:
+        poller = pollers.setdefault(region, RegionPoller(region))
+
+    poller.wait(instance_ids, state, timeout)
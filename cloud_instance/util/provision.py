@@ -2,94 +2,70 @@ import json
 import logging
 import os
 import random
-from threading import Lock, Thread
-
-# AWS
-import boto3
-
-# AZURE
-from azure.identity import EnvironmentCredential
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.network import NetworkManagementClient
-from google.api_core.extended_operation import ExtendedOperation
-
-# GCP
-from google.cloud.compute_v1 import (
-    AccessConfig,
-    AddressesClient,
-    AttachedDisk,
-    AttachedDiskInitializeParams,
-    Instance,
-    InstancesClient,
-    NetworkInterface,
-    Tags,
-)
-from google.cloud.compute_v1.services.addresses.client import AddressesClient
-from google.cloud.compute_v1.services.global_addresses import GlobalAddressesClient
-from google.cloud.compute_v1.types import Address, Items, Metadata
-
-from .common import wait_for_extended_operation
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from typing import Callable
+
+from . import images, inventory, operations, poller, throttle
+from .clients import aws_client, azure_compute_client, gcp_client
+from .common import MAX_WORKERS
+from .context import RunContext
 from .parse import parse_aws_query, parse_azure_query, parse_gcp_query
 
 logger = logging.getLogger("cloud_instance")
 
-instances: list[dict] = []
-errors: list[str] = []
-defaults: dict = {}
 
-
-def update_new_deployment(_instances: list):
-    global instances
-    with Lock():
-        logger.debug("Updating pre-existing instances list")
-        instances += _instances
-
-
-def update_errors(error: str):
-    global errors
-    logger.error(error)
-    with Lock():
-        errors.append(error)
-
-
-def get_instance_type(group: dict):
+def get_instance_type(ctx: RunContext, group: dict):
     if "instance_type" in group:
         return group["instance_type"]
 
     # instance type
     cpu = str(group["instance"].get("cpu"))
     if cpu == "None":
-        update_errors("instance cpu cannot be null")
+        ctx.add_error("instance cpu cannot be null")
         return
 
     mem = str(group["instance"].get("mem", "default"))
     cloud = group["cloud"]
-    global defaults
 
-    return defaults[cloud][cpu][mem]
+    return ctx.defaults[cloud][cpu][mem]
+
 
+def provision(
+    deployment_id: str,
+    new_vms: list[tuple[Callable, tuple]],
+    instance_defaults,
+) -> list[dict]:
+    # new_vms are the (target, args) of each thread, as returned by build
+    ctx = RunContext(instance_defaults)
 
-def provision(new_vms: list[Thread], instance_defaults) -> list[dict]:
-    global defaults
-    defaults = instance_defaults
+    threads = [Thread(target=target, args=(ctx, *args)) for target, args in new_vms]
 
-    for x in new_vms:
+    for x in threads:
         x.start()
 
-    for x in new_vms:
+    for x in threads:
         x.join()
 
-    global instances
-    global errors
+    # write the new instances through to the inventory cache
+    inventory.add(deployment_id, ctx.instances)
 
-    if errors:
+    # some instances might exist without being cached: on failure, and for
+    # Azure, whose driver doesn't report the instances it creates
+    if ctx.errors or any(target is provision_azure_vm for target, _ in new_vms):
+        inventory.invalidate(deployment_id)
+
+    if ctx.errors:
         raise ValueError("Failed to provision instances.")
 
-    return instances
+    return ctx.instances
 
 
-def provision_aws_vm(deployment_id: str, cluster_name: str, group: dict, x: int):
-    logger.debug("++aws %s %s %s" % (cluster_name, group["region"], x))
+def provision_aws_vm(
+    ctx: RunContext, deployment_id: str, cluster_name: str, group: dict, count: int
+):
+    # all `count` VMs of the group are launched with a single request
+    logger.debug("++aws %s %s %s" % (cluster_name, group["region"], count))
 
     # volumes
     def get_type(x):
@@ -156,22 +132,24 @@ def provision_aws_vm(deployment_id: str, cluster_name: str, group: dict, x: int)
         # get latest AMI
         arch = group.get("instance", {}).get("arch", "amd64")
 
-        image_id = boto3.client("ssm", region_name=group["region"]).get_parameter(
-            Name=f"/aws/service{group['image']}/stable/current/{arch}/hvm/ebs-gp3/ami-id"
-        )["Parameter"]["Value"]
+        image_id = images.resolve("aws", group["region"], group["image"], arch)
 
         # logger.debug(f"Arch: {arch}, AMI: {image_id}")
 
-        ec2 = boto3.client("ec2", region_name=group["region"])
+        ec2 = aws_client("ec2", group["region"])
 
-        response = ec2.run_instances(
+        response = throttle.call(
+            "aws",
+            group["region"],
+            "run_instances",
+            ec2.run_instances,
             DryRun=False,
             BlockDeviceMappings=bdm,
             ImageId=image_id,
-            InstanceType=get_instance_type(group),
+            InstanceType=get_instance_type(ctx, group),
             KeyName=group["public_key_id"],
-            MaxCount=1,
-            MinCount=1,
+            MaxCount=count,
+            MinCount=count,
             UserData=group.get("user_data", ""),
             IamInstanceProfile=role,
             NetworkInterfaces=[
@@ -190,62 +168,85 @@ def provision_aws_vm(deployment_id: str, cluster_name: str, group: dict, x: int)
             ],
         )
 
-        # wait until instance is running
-        waiter = ec2.get_waiter("instance_running")
-        waiter.wait(InstanceIds=[response["Instances"][0]["InstanceId"]])
-
-        allocation = ec2.allocate_address(Domain="vpc")
-        resp = ec2.associate_address(
-            AllocationId=allocation["AllocationId"],
-            InstanceId=response["Instances"][0]["InstanceId"],
-        )
-
-        # fetch details about the newly created instance
-        response = ec2.describe_instances(
-            InstanceIds=[response["Instances"][0]["InstanceId"]]
+        instance_ids = [x["InstanceId"] for x in response["Instances"]]
+
+        # wait until all instances are running
+        poller.wait(group["region"], instance_ids, "running")
+
+        # there is no batch API for Elastic IPs, so at least run them concurrently
+        with ThreadPoolExecutor(
+            max_workers=min(len(instance_ids), MAX_WORKERS)
+        ) as pool:
+            for x in instance_ids:
+                pool.submit(associate_aws_address, ctx, ec2, x)
+
+        # fetch details about the newly created instances
+        response = throttle.call(
+            "aws",
+            group["region"],
+            "describe",
+            ec2.describe_instances,
+            InstanceIds=instance_ids,
         )
 
-        # add the instance to the list
-        update_new_deployment(parse_aws_query(response))
+        # add the instances to the list
+        ctx.add_instances(parse_aws_query(response))
     except Exception as e:
-        update_errors(e)
-
+        ctx.add_error(e)
 
-def provision_gcp_vm(deployment_id: str, cluster_name: str, group: dict, x: int):
-    logger.info("++gcp %s %s %s" % (cluster_name, group["group_name"], x))
 
-    gcp_project = os.getenv("GCP_PROJECT")
-    if not gcp_project:
-        raise ValueError("GCP_PROJECT env var is not defined")
+def associate_aws_address(ctx: RunContext, ec2, instance_id: str):
+    region = ec2.meta.region_name
 
-    gcpzone = "-".join([group["region"], group["zone"]])
+    try:
+        allocation = throttle.call(
+            "aws", region, "addresses", ec2.allocate_address, Domain="vpc"
+        )
+        throttle.call(
+            "aws",
+            region,
+            "addresses",
+            ec2.associate_address,
+            AllocationId=allocation["AllocationId"],
+            InstanceId=instance_id,
+        )
+    except Exception as e:
+        ctx.add_error(e)
 
-    instance_name = deployment_id + "-" + str(random.randint(0, 1e16)).zfill(16)
 
-    instance_client = InstancesClient()
-    addresses_client = AddressesClient()
+def provision_gcp_vm(
+    ctx: RunContext, deployment_id: str, cluster_name: str, group: dict, count: int
+):
+    # all `count` VMs of the group are created with a single bulk insert
+    logger.info("++gcp %s %s %s" % (cluster_name, group["group_name"], count))
+
+    # GCP
+    from google.cloud.compute_v1 import (
+        AccessConfig,
+        Address,
+        AttachedDisk,
+        AttachedDiskInitializeParams,
+        BulkInsertInstanceResource,
+        InstanceProperties,
+        Items,
+        Metadata,
+        NetworkInterface,
+        Tags,
+    )
 
     try:
-        op = addresses_client.insert(
-            project=gcp_project,
-            region=group["region"],
-            address_resource=Address(
-                name=f"{instance_name}-eip",
-            ),
-        )
-        wait_for_extended_operation(op)
+        gcp_project = os.getenv("GCP_PROJECT")
+        if not gcp_project:
+            raise ValueError("GCP_PROJECT env var is not defined")
 
-        # Get the reserved IP address
-        reserved = addresses_client.get(
-            project=gcp_project,
-            region=group["region"],
-            address=f"{instance_name}-eip",
-        )
-        reserved_ip = reserved.address
+        gcpzone = "-".join([group["region"], group["zone"]])
 
-        logger.info(
-            f"GCP External IP address reserved successfully: {instance_name}-eip"
-        )
+        # same shape as a single instance name: the trailing #### are replaced
+        # with the sequence number of each VM in the batch
+        name_prefix = deployment_id + "-" + str(random.randint(0, 10**12 - 1)).zfill(12)
+
+        instance_client = gcp_client("InstancesClient")
+        addresses_client = gcp_client("AddressesClient")
 
         # volumes
         def get_type(x):
@@ -262,11 +263,17 @@ def provision_gcp_vm(deployment_id: str, cluster_name: str, group: dict, x: int)
         boot_disk = AttachedDisk()
         boot_disk.boot = True
         initialize_params = AttachedDiskInitializeParams()
-        initialize_params.source_image = group["image"]
+        # pin the image family to its current image
+        initialize_params.source_image = images.resolve(
+            "gcp",
+            group["region"],
+            group["image"],
+            group.get("instance", {}).get("arch", "amd64"),
+        )
         initialize_params.disk_size_gb = int(group["volumes"]["os"].get("size", 30))
-        initialize_params.disk_type = "zones/%s/diskTypes/%s" % (
-            gcpzone,
-            get_type(group["volumes"]["os"].get("type", "standard_ssd")),
+        # instance properties take the name of the disk type, not its URL
+        initialize_params.disk_type = get_type(
+            group["volumes"]["os"].get("type", "standard_ssd")
         )
         boot_disk.initialize_params = initialize_params
         boot_disk.auto_delete = group["volumes"]["os"].get(
@@ -287,10 +294,7 @@ def provision_gcp_vm(deployment_id: str, cluster_name: str, group: dict, x: int)
                 del init_params.disk_size_gb
                 disk.device_name = f"local-ssd-{i}"
 
-            init_params.disk_type = "zones/%s/diskTypes/%s" % (
-                gcpzone,
-                get_type(x.get("type", "standard_ssd")),
-            )
+            init_params.disk_type = get_type(x.get("type", "standard_ssd"))
 
             disk.initialize_params = init_params
             disk.auto_delete = x.get("delete_on_termination", True)
@@ -339,68 +343,111 @@ def provision_gcp_vm(deployment_id: str, cluster_name: str, group: dict, x: int)
         network_interface = NetworkInterface()
         network_interface.name = group["subnet"]
 
+        # every VM in the batch shares the same properties, so the external IP
+        # is ephemeral here and promoted to a static address once assigned
         if group["public_ip"]:
             access = AccessConfig()
             access.type_ = AccessConfig.Type.ONE_TO_ONE_NAT.name
             access.name = "External NAT"
             access.network_tier = access.NetworkTier.PREMIUM.name
-            access.nat_i_p = reserved_ip
             network_interface.access_configs = [access]
 
-        # Collect information into the Instance object.
-        instance = Instance()
-        instance.name = instance_name
-        instance.disks = vols
-        instance.machine_type = (
-            f"zones/{gcpzone}/machineTypes/{get_instance_type(group)}"
-        )
-        instance.metadata = tags
-        instance.labels = {"deployment_id": deployment_id}
+        # Collect information into the InstanceProperties object.
+        properties = InstanceProperties()
+        properties.disks = vols
+        # instance properties take the name of the machine type, not its URL
+        properties.machine_type = get_instance_type(ctx, group)
+        properties.metadata = tags
+        properties.labels = {"deployment_id": deployment_id}
 
         t = Tags()
         t.items = group["security_groups"]
-        instance.tags = t
-
-        instance.network_interfaces = [network_interface]
-
-        operation = instance_client.insert(
-            instance_resource=instance, project=gcp_project, zone=gcpzone
+        properties.tags = t
+
+        properties.network_interfaces = [network_interface]
+
+        resource = BulkInsertInstanceResource()
+        resource.name_pattern = name_prefix + "####"
+        resource.count = count
+        resource.min_count = count
+        resource.instance_properties = properties
+
+        operation = throttle.call(
+            "gcp",
+            group["region"],
+            "instances",
+            instance_client.bulk_insert,
+            bulk_insert_instance_resource_resource=resource,
+            project=gcp_project,
+            zone=gcpzone,
         )
 
-        wait_for_extended_operation(operation)
+        operations.check([operation])
 
-        logger.debug(f"GCP instance created: {instance.name}")
+        logger.debug(f"GCP instances created: {name_prefix}####")
 
-        # fetch details
-        instance = instance_client.get(
-            project=gcp_project, zone=gcpzone, instance=instance_name
+        # fetch details of the whole batch with a single call
+        new_instances = list(
+            instance_client.list(
+                project=gcp_project,
+                zone=gcpzone,
+                filter=f'name eq "{name_prefix}[0-9]+"',
+            )
         )
 
-        # add the instance to the list
-        update_new_deployment(
-            [parse_gcp_query(instance, group["region"], group["zone"])]
+        # promote the ephemeral IPs to static addresses named after the instance,
+        # as terminate expects. Submit all of them before waiting on any
+        ops = [
+            (
+                x.name,
+                throttle.call(
+                    "gcp",
+                    group["region"],
+                    "addresses",
+                    addresses_client.insert,
+                    project=gcp_project,
+                    region=group["region"],
+                    address_resource=Address(
+                        name=f"{x.name}-eip",
+                        address=x.network_interfaces[0].access_configs[0].nat_i_p,
+                    ),
+                ),
+            )
+            for x in new_instances
+            if group["public_ip"]
+        ]
+
+        for (name, _), error in zip(ops, operations.wait([x[1] for x in ops])):
+            if error:
+                ctx.add_error(f"Failed to reserve {name}-eip: {error}")
+            else:
+                logger.info(
+                    f"GCP External IP address reserved successfully: {name}-eip"
+                )
+
+        # add the instances to the list
+        ctx.add_instances(
+            [parse_gcp_query(x, group["region"], group["zone"]) for x in new_instances]
         )
 
     except Exception as e:
-        update_errors(e)
+        ctx.add_error(e)
 
 
 def provision_azure_vm(
-    deployment_id: str,
-    cluster_name: str,
-    group: dict,
-    x: int,
-    azure_subscription_id,
-    azure_resource_group,
+    ctx: RunContext, deployment_id: str, cluster_name: str, group: dict, x: int
 ):
     logger.debug("++azure %s %s %s" % (cluster_name, group["group_name"], x))
 
+    azure_subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
+    azure_resource_group = os.getenv("AZURE_RESOURCE_GROUP")
+
     try:
-        # Acquire a credential object using CLI-based authentication.
-        credential = EnvironmentCredential()
-        client = ComputeManagementClient(credential, azure_subscription_id)
+        client = azure_compute_client(azure_subscription_id)
 
-        instance_name = deployment_id + "-" + str(random.randint(0, 1e16)).zfill(16)
+        instance_name = (
+            deployment_id + "-" + str(random.randint(0, 10**16 - 1)).zfill(16)
+        )
 
         def get_type(x):
             return {
@@ -411,39 +458,36 @@ def provision_azure_vm(
                 "premium_hdd": "Standard_LRS",
             }.get(x, "Premium_LRS")
 
+        # data disks are created empty along with the VM,
+        # so there are no disk operations to wait on before submitting it
         vols = []
         i: int
         x: dict
 
         for i, x in enumerate(group["volumes"]["data"]):
-            poller = client.disks.begin_create_or_update(
-                azure_resource_group,
-                instance_name + "-disk-" + str(i),
-                {
-                    "location": group["region"],
-                    "sku": {"name": get_type(x.get("type", "standard_ssd"))},
-                    "disk_size_gb": int(x.get("size", 100)),
-                    "creation_data": {"create_option": "Empty"},
-                },
-            )
-
             #     "diskIOPSReadWrite": "15000",
             # "diskMBpsReadWrite": "250"
-            data_disk = poller.result()
-
             disk = {
                 "lun": i,
                 "name": instance_name + "-disk-" + str(i),
-                "create_option": "Attach",
+                "create_option": "Empty",
+                "disk_size_gb": int(x.get("size", 100)),
                 "delete_option": (
                     "Delete" if x.get("delete_on_termination", True) else "Detach"
                 ),
-                "managed_disk": {"id": data_disk.id},
+                "managed_disk": {
+                    "storage_account_type": get_type(x.get("type", "standard_ssd"))
+                },
             }
             vols.append(disk)
 
-        # Provision the virtual machine
-        publisher, offer, sku, version = group["image"].split(":")
+        # Provision the virtual machine, pinning a "latest" version
+        publisher, offer, sku, version = images.resolve(
+            "azure",
+            group["region"],
+            group["image"],
+            group.get("instance", {}).get("arch", "amd64"),
+        ).split(":")
 
         nsg = None
         if group["security_groups"]:
@@ -456,7 +500,11 @@ def provision_azure_vm(
                 )
             }
 
-        poller = client.virtual_machines.begin_create_or_update(
+        poller = throttle.call(
+            "azure",
+            group["region"],
+            "virtual_machines",
+            client.virtual_machines.begin_create_or_update,
             azure_resource_group,
             instance_name,
             {
@@ -486,7 +534,7 @@ def provision_azure_vm(
                     "data_disks": vols,
                 },
                 "hardware_profile": {
-                    "vm_size": get_instance_type(group),
+                    "vm_size": get_instance_type(ctx, group),
                 },
                 "os_profile": {
                     "computer_name": instance_name,
@@ -542,7 +590,7 @@ def provision_azure_vm(
         instance = poller.result()
 
         # add the instance to the list
-        # update_new_deployment(
+        # ctx.add_instances(
         #     parse_azure_query(
         #         instance,
         #         *fetch_azure_instance_network_config(instance),
@@ -550,4 +598,4 @@ def provision_azure_vm(
         # )
 
     except Exception as e:
-        update_errors(e)
+        ctx.add_error(e)
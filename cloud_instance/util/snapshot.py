@@ -0,0 +1,67 @@
+import hashlib
+import json
+import logging
+
+from .common import write_json
+
+logger = logging.getLogger("cloud_instance")
+
+
+def digest(instances: list[dict]) -> str:
+    # content hash that doesn't depend on the order instances were fetched in
+    ordered = sorted(instances, key=lambda x: (x["cloud"], x["id"]))
+    return hashlib.sha256(
+        json.dumps(ordered, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def load(path: str) -> dict | None:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.warning(f"Ignoring unreadable snapshot {path}")
+        return None
+
+
+def save(path: str, instances: list[dict], hash: str) -> None:
+    write_json(path, {"hash": hash, "instances": instances})
+
+
+def diff(old: list[dict], new: list[dict]) -> dict:
+    old_by_key = {(x["cloud"], x["id"]): x for x in old}
+    new_by_key = {(x["cloud"], x["id"]): x for x in new}
+
+    return {
+        "added": [v for k, v in new_by_key.items() if k not in old_by_key],
+        "removed": [v for k, v in old_by_key.items() if k not in new_by_key],
+        "changed": [
+            v for k, v in new_by_key.items() if k in old_by_key and old_by_key[k] != v
+        ],
+    }
+
+
+def delta(path: str, instances: list[dict]) -> dict:
+    """
+    Compare `instances` with the snapshot at `path`, then replace the snapshot.
+
+    Returns the new content hash with the added, removed and changed records.
+    When the hash matches the snapshot, the delta is empty and nothing is
+    diffed or rewritten.
+    """
+    hash = digest(instances)
+    snapshot = load(path)
+
+    if snapshot and snapshot.get("hash") == hash:
+        return {"hash": hash, "added": [], "removed": [], "changed": []}
+
+    result = {
+        "hash": hash,
+        **diff(snapshot["instances"] if snapshot else [], instances),
+    }
+
+    save(path, instances, hash)
+
+    return result
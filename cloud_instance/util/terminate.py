@@ -1,62 +1,63 @@
 import logging
 import os
-from threading import Lock, Thread
-
-# AWS
-import boto3
-
-# AZURE
-from azure.identity import EnvironmentCredential
-from azure.mgmt.compute import ComputeManagementClient
-
-# GCP
-from google.cloud.compute_v1 import InstancesClient
-from google.cloud.compute_v1.services.addresses.client import AddressesClient
+from threading import Thread
 
+from . import inventory, operations, poller, throttle
+from .clients import aws_client, azure_compute_client, gcp_client
+from .context import RunContext
 from .fetch import fetch
 
 logger = logging.getLogger("cloud_instance")
 
-errors: list[str] = []
-
 
 def terminate(instances: list[dict]) -> None:
 
+    ctx = RunContext()
     threads: list[Thread] = []
 
     for x in instances:
+        if x["cloud"] == "gcp":
+            continue
+
         thread = Thread(
             target={
                 "aws": terminate_aws_vm,
-                "gcp": terminate_gcp_vm,
                 "azure": terminate_azure_vm,
             }.get(x["cloud"]),
-            args=(x,),
+            args=(ctx, x),
         )
         thread.start()
         threads.append(thread)
         logger.info(f"Deleting instance: {x}")
 
+    # GCP operations are tracked as a batch, one thread is enough
+    gcp_instances = [x for x in instances if x["cloud"] == "gcp"]
+    if gcp_instances:
+        thread = Thread(target=terminate_gcp_vms, args=(ctx, gcp_instances))
+        thread.start()
+        threads.append(thread)
+
     for x in threads:
         x.join()
 
-    global errors
+    # drop the deleted instances from the inventory cache.
+    # On failure we can't tell which ones are gone, so expire their deployments
+    inventory.remove(instances, invalidate=bool(ctx.errors))
 
-    if errors:
+    if ctx.errors:
         raise ValueError(f"Failed to terminate instances.")
 
 
-def update_errors(error: str):
-    global errors
-    logger.error(error)
-    with Lock():
-        errors.append(error)
-
-
-def terminate_aws_vm(instance: dict):
+def terminate_aws_vm(ctx: RunContext, instance: dict):
 
     def get_allocation_id(public_ip, instance_id):
-        response = ec2.describe_addresses(PublicIps=[public_ip])
+        response = throttle.call(
+            "aws",
+            instance["region"],
+            "addresses",
+            ec2.describe_addresses,
+            PublicIps=[public_ip],
+        )
 
         for address in response["Addresses"]:
             # Check if the EIP is associated with the given instance ID
@@ -73,16 +74,19 @@ def terminate_aws_vm(instance: dict):
     logger.info(f"--aws {instance['id']}")
 
     try:
-        ec2 = boto3.client("ec2", region_name=instance["region"])
+        ec2 = aws_client("ec2", instance["region"])
 
         alloc = get_allocation_id(instance["public_ip"], instance["id"])
 
-        response = ec2.terminate_instances(
+        response = throttle.call(
+            "aws",
+            instance["region"],
+            "terminate_instances",
+            ec2.terminate_instances,
             InstanceIds=[instance["id"]],
         )
 
-        waiter = ec2.get_waiter("instance_terminated")
-        waiter.wait(InstanceIds=[instance["id"]])
+        poller.wait(instance["region"], [instance["id"]], "terminated")
 
         status = response["TerminatingInstances"][0]["CurrentState"]["Name"]
 
@@ -90,61 +94,116 @@ def terminate_aws_vm(instance: dict):
             logger.info(f"Deleted AWS instance: {instance['id']}")
         else:
             logger.error(f"Unexpected response: {response}")
-            update_errors(str(response))
-
-        ec2.release_address(AllocationId=alloc)
+            ctx.add_error(str(response))
+
+        throttle.call(
+            "aws",
+            instance["region"],
+            "addresses",
+            ec2.release_address,
+            AllocationId=alloc,
+        )
 
     except Exception as e:
-        update_errors(str(e))
+        ctx.add_error(str(e))
 
 
-def terminate_gcp_vm(instance: dict):
-    logger.debug(f"--gcp {instance['id']}")
+def terminate_gcp_vms(ctx: RunContext, instances: list[dict]):
+    # all GCP instances are deleted together: submit every delete, wait on
+    # them as a batch, then release the addresses of the instances that are gone
+    for x in instances:
+        logger.debug(f"--gcp {x['id']}")
 
     gcp_project = os.getenv("GCP_PROJECT")
     if not gcp_project:
-        raise ValueError("Env var GCP_PROJECT not set.")
+        ctx.add_error("Env var GCP_PROJECT not set.")
+        return
 
+    # any failure outside the per-instance calls, eg no credentials, must
+    # still be reported, or terminate would drop live instances from the cache
     try:
-        instance_client = InstancesClient()
-
-        op = instance_client.delete(
-            project=gcp_project,
-            zone=f"{instance['region']}-{instance['zone']}",
-            instance=instance["id"],
-        )
-        # wait_for_extended_operation(op)
-        logger.info(f"Deleting GCP instance: {instance}")
-
-        client = AddressesClient()
-        op = client.delete(
-            project=gcp_project,
-            region=instance["region"],
-            address=f"{instance['id']}-eip",
-        )
-
-        logger.info(f"GCP External IP address {instance['id']} released successfully.")
+        instance_client = gcp_client("InstancesClient")
+        client = gcp_client("AddressesClient")
+
+        deleting = []
+        for instance in instances:
+            try:
+                op = throttle.call(
+                    "gcp",
+                    instance["region"],
+                    "instances",
+                    instance_client.delete,
+                    project=gcp_project,
+                    zone=f"{instance['region']}-{instance['zone']}",
+                    instance=instance["id"],
+                )
+                deleting.append((instance, op))
+                logger.info(f"Deleting GCP instance: {instance}")
+            except Exception as e:
+                ctx.add_error(e)
+
+        # the address can only be released once the instance no longer holds it
+        releasing = []
+        for (instance, _), error in zip(
+            deleting, operations.wait([x[1] for x in deleting])
+        ):
+            if error:
+                ctx.add_error(
+                    f"Failed to delete GCP instance {instance['id']}: {error}"
+                )
+                continue
+
+            try:
+                op = throttle.call(
+                    "gcp",
+                    instance["region"],
+                    "addresses",
+                    client.delete,
+                    project=gcp_project,
+                    region=instance["region"],
+                    address=f"{instance['id']}-eip",
+                )
+                releasing.append((instance, op))
+            except Exception as e:
+                # instances without a public IP have no address to release
+                if getattr(e, "code", None) == 404:
+                    continue
+                ctx.add_error(e)
+
+        for (instance, _), error in zip(
+            releasing, operations.wait([x[1] for x in releasing])
+        ):
+            if error:
+                ctx.add_error(
+                    f"Failed to release GCP address {instance['id']}-eip: {error}"
+                )
+            else:
+                logger.info(
+                    f"GCP External IP address {instance['id']} released successfully."
+                )
 
     except Exception as e:
-        update_errors(e)
+        ctx.add_error(e)
 
 
-def terminate_azure_vm(instance: dict):
+def terminate_azure_vm(ctx: RunContext, instance: dict):
     logger.debug(f"--azure {instance['id']}")
 
     azure_subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
     azure_resource_group = os.getenv("AZURE_RESOURCE_GROUP")
 
-    # Acquire a credential object using CLI-based authentication.
     try:
-        credential = EnvironmentCredential()
-
-        client = ComputeManagementClient(credential, azure_subscription_id)
-
-        async_vm_delete = client.virtual_machines.begin_delete(
-            azure_resource_group, instance["id"]
+        client = azure_compute_client(azure_subscription_id)
+
+        async_vm_delete = throttle.call(
+            "azure",
+            instance["region"],
+            "virtual_machines",
+            client.virtual_machines.begin_delete,
+            azure_resource_group,
+            instance["id"],
         )
         async_vm_delete.wait()
 
     except Exception as e:
-        update_errors(e)
+        ctx.add_error(e)
@@ -0,0 +1,192 @@
+import logging
+import os
+import random
+import time
+from threading import Condition, Lock
+from typing import Callable
+
+logger = logging.getLogger("cloud_instance")
+
+# sustained calls per second and burst size of each (cloud, region, family) bucket
+RATE = float(os.getenv("CLOUD_INSTANCE_RATE", 5))
+BURST = int(os.getenv("CLOUD_INSTANCE_BURST", 20))
+
+# upper bound on the concurrent calls of a bucket, the AIMD limit moves below it
+CONCURRENCY = int(os.getenv("CLOUD_INSTANCE_CONCURRENCY", 16))
+
+# attempts of a throttled call before giving up, and the backoff cap in seconds
+RETRIES = int(os.getenv("CLOUD_INSTANCE_RETRIES", 8))
+BACKOFF_CAP = float(os.getenv("CLOUD_INSTANCE_BACKOFF_CAP", 60))
+
+# error codes meaning "slow down", as opposed to real failures.
+# AWS and Azure report them as the error code, GCP as the error reason
+THROTTLING_CODES = {
+    # AWS
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "SlowDown",
+    # GCP
+    "RATE_LIMIT_EXCEEDED",
+    "rateLimitExceeded",
+    "userRateLimitExceeded",
+    # Azure
+    "TooManyRequests",
+    "OperationNotAllowed.TooManyRequests",
+}
+
+# AWS errors worth retrying as they are, with botocore's own retries disabled
+TRANSIENT_CODES = {
+    "InternalError",
+    "InternalFailure",
+    "ServiceUnavailable",
+    "Unavailable",
+    "RequestTimeout",
+    "RequestTimeoutException",
+}
+TRANSIENT_ERRORS = {
+    "EndpointConnectionError",
+    "ConnectionClosedError",
+    "ConnectTimeoutError",
+    "ReadTimeoutError",
+}
+
+
+class Bucket:
+    """
+    A token bucket refilled at `rate` calls per second, combined with an
+    AIMD concurrency limit: halved on a throttling response, grown back by
+    one call per window of successful calls.
+
+    Like TCP, the decrease happens at most once per congestion window: only
+    a call started after the last decrease can trigger the next one, so a
+    burst of throttled calls in flight together halves the limits once.
+    """
+
+    def __init__(self, rate: float = RATE, burst: int = BURST):
+        self.cond = Condition()
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.limit = float(CONCURRENCY)
+        self.in_flight = 0
+        self.decreased_at = 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> float:
+        # returns the time the call started, to hand back to release
+        with self.cond:
+            while True:
+                self.refill()
+                if self.in_flight < int(self.limit) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return time.monotonic()
+                # sleep until the next token, or until a call completes
+                self.cond.wait(max((1 - self.tokens) / self.rate, 0.01))
+
+    def release(self, started: float, throttled: bool):
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                if started >= self.decreased_at:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.rate = max(self.max_rate / 16, self.rate / 2)
+                    self.decreased_at = time.monotonic()
+            else:
+                self.limit = min(float(CONCURRENCY), self.limit + 1 / self.limit)
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 16)
+            self.cond.notify_all()
+
+
+buckets: dict[tuple, Bucket] = {}
+buckets_lock = Lock()
+
+
+def get_bucket(cloud: str, region: str, family: str) -> Bucket:
+    with buckets_lock:
+        return buckets.setdefault((cloud, region, family), Bucket())
+
+
+def get_error_codes(e: Exception) -> set:
+    # duck typed, so the provider SDKs don't need to be imported here
+    codes = set()
+
+    # botocore ClientError
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        codes.add(response.get("Error", {}).get("Code"))
+
+    # google.api_core GoogleAPICallError
+    codes.add(getattr(e, "reason", None))
+    for x in getattr(e, "errors", None) or []:
+        if isinstance(x, dict):
+            codes.add(x.get("reason"))
+
+    # azure.core HttpResponseError
+    codes.add(getattr(getattr(e, "error", None), "code", None))
+
+    return codes
+
+
+def is_throttled(e: Exception) -> bool:
+    # google.api_core and azure.core HTTP errors
+    if getattr(e, "code", None) == 429 or getattr(e, "status_code", None) == 429:
+        return True
+
+    return bool(get_error_codes(e) & THROTTLING_CODES)
+
+
+def is_transient(e: Exception) -> bool:
+    # only AWS: the GCP and Azure SDKs retry these on their own
+    if type(e).__name__ in TRANSIENT_ERRORS:
+        return True
+
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return status >= 500 or bool(get_error_codes(e) & TRANSIENT_CODES)
+
+    return False
+
+
+def call(cloud: str, region: str, family: str, func: Callable, /, *args, **kwargs):
+    """
+    Call `func` once the (cloud, region, family) bucket allows it.
+
+    Throttled and transient failures are retried with full jitter
+    exponential backoff. Throttling also slows down the bucket for every
+    other caller sharing it.
+    """
+    bucket = get_bucket(cloud, region, family)
+
+    for attempt in range(RETRIES):
+        started = bucket.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            throttled = is_throttled(e)
+            bucket.release(started, throttled)
+
+            if not (throttled or is_transient(e)) or attempt == RETRIES - 1:
+                raise
+
+            delay = random.uniform(0, min(BACKOFF_CAP, 2**attempt))
+            logger.warning(
+                f"{'Throttled' if throttled else 'Failed'} by {cloud} {region} "
+                f"{family}, retrying in {delay:.1f}s: {e}"
+            )
+            time.sleep(delay)
+        else:
+            bucket.release(started, False)
+            return result
@@ -0,0 +1,120 @@
+import logging
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from threading import Condition, Thread
+from typing import Hashable
+
+logger = logging.getLogger("cloud_instance")
+
+
+class Tracker(ABC):
+    """
+    Poll the remote state of everything some thread is waiting on, with a
+    single background thread and as few calls as `poll` can batch them into.
+
+    The thread starts with the first waiter and exits with the last one.
+    The interval between polls resets to `min_interval` whenever a key
+    changes or a new one is tracked, then grows up to `max_interval` while
+    nothing moves.
+    """
+
+    def __init__(self, name: str, min_interval: float, max_interval: float):
+        self.name = name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.cond = Condition()
+        # key -> number of waiters interested in it
+        self.pending: dict[Hashable, int] = {}
+        # key -> last polled value
+        self.results: dict[Hashable, object] = {}
+        self.interval = min_interval
+        self.thread: Thread | None = None
+
+    @abstractmethod
+    def poll(self, keys: list) -> dict:
+        # return the current value of the keys that have one
+        ...
+
+    def needs_poll(self, key: Hashable) -> bool:
+        return True
+
+    @contextmanager
+    def track(self, keys: list):
+        """
+        Track `keys` for the duration of the block, holding `cond`, which
+        the caller waits on until `results` has what it needs.
+        """
+        with self.cond:
+            for x in keys:
+                self.pending[x] = self.pending.get(x, 0) + 1
+
+            # poll soon, the caller just changed the state of these keys
+            self.interval = self.min_interval
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+            try:
+                yield
+            finally:
+                for x in keys:
+                    self.pending[x] -= 1
+                    if not self.pending[x]:
+                        del self.pending[x]
+                        self.results.pop(x, None)
+
+    def run(self):
+        try:
+            self.loop()
+        except BaseException:
+            # let the next waiter start a new thread
+            with self.cond:
+                self.thread = None
+            raise
+
+    def loop(self):
+        while True:
+            with self.cond:
+                if not self.pending:
+                    self.thread = None
+                    return
+                keys = [x for x in self.pending if self.needs_poll(x)]
+
+            try:
+                results = self.poll(keys) if keys else {}
+            except Exception as e:
+                # try again next tick, the waiters time out if it keeps failing
+                logger.error(f"{self.name}: poll failed: {e}")
+                results = {}
+
+            with self.cond:
+                changed = False
+                for k, v in results.items():
+                    if k in self.pending and (
+                        k not in self.results or self.results[k] != v
+                    ):
+                        self.results[k] = v
+                        changed = True
+
+                if changed:
+                    self.interval = self.min_interval
+                    self.cond.notify_all()
+                else:
+                    self.interval = min(self.interval * 1.5, self.max_interval)
+
+                logger.debug(
+                    f"{self.name}: polled {len(keys)}, "
+                    f"next poll in {self.interval:.1f}s"
+                )
+
+                # new waiters notify, so they get polled right away
+                deadline = time.monotonic() + self.interval
+                while self.pending and time.monotonic() < deadline:
+                    if not self.cond.wait(deadline - time.monotonic()):
+                        break
+                    if any(
+                        x not in keys and x not in self.results for x in self.pending
+                    ):
+                        break